@@ -0,0 +1,88 @@
+import os
+import glob
+import json
+import time
+import queue
+import logging
+import threading
+import soundfile as sf
+
+def clear_outputs(odir):
+    """ creates odir or removes the transcripts and audio files saved there by a previous run """
+    if not os.path.exists(odir):
+        os.makedirs(odir)
+        return
+    for fname in glob.glob(os.path.join(odir, 'audio.*')) + glob.glob(os.path.join(odir, 'transcripts.*')):
+        os.remove(fname)
+
+class Archiver():
+
+    def __init__(self, odir, sample_rate=16000, stats=None):
+        """
+        Archives the transcripts as they are created (instead of saving everything at exit): a writer thread encodes the
+        audio of each transcript in its own FLAC file and appends a json line to transcripts.jsonl (flushed after each
+        transcript, so that only the queued transcripts are lost on a crash). The audio given is a copy: the capture
+        buffer can release it as soon as the transcript is submitted
+        Params:
+        odir: output directory (files of a previous run are removed)
+        sample_rate: the sample rate of the audio wave
+        stats: (optional) dict of lists receiving time_ARCHIVE and bytes_ARCHIVE
+        """
+        self.odir = odir
+        self.sample_rate = sample_rate
+        self.stats = stats
+        self.queue = queue.Queue()
+        self.index = 0
+        clear_outputs(odir)
+        self.fdesc = open(os.path.join(odir, 'transcripts.jsonl'), 'a')
+        self.thread = threading.Thread(target=self.run, name='archiver', daemon=True)
+        self.thread.start()
+
+    def submit(self, transcript, audio):
+        """ queues transcript (dict with start, end, str, language) and its audio (numpy.ndarray float32) """
+        self.queue.put((transcript, audio))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.write(*item)
+            except Exception as e:
+                logging.error('transcript [{}, {}) not archived: {}'.format(item[0]['start'], item[0]['end'], e))
+
+    def write(self, transcript, audio):
+        tic = time.time()
+        tstart = "{:.2f}".format(transcript['start'] / self.sample_rate)
+        tend = "{:.2f}".format(transcript['end'] / self.sample_rate)
+        fname = 'audio.{}_{}_{}.flac'.format(self.index, tstart, tend)
+        path = os.path.join(self.odir, fname)
+        if audio is not None:
+            sf.write(path, audio, self.sample_rate)
+        record = {
+            'index': self.index,
+            'start': transcript['start'],
+            'end': transcript['end'],
+            'start_sec': float(tstart),
+            'end_sec': float(tend),
+            'text': transcript['str'],
+            'language': transcript.get('language'),
+            'end_by': transcript.get('end_by'),
+            'final': transcript.get('final', False),
+            'audio': fname if audio is not None else None}
+        self.fdesc.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.fdesc.flush()
+        self.index += 1
+        if self.stats is not None:
+            self.stats['time_ARCHIVE'].append(time.time() - tic)
+            self.stats['bytes_ARCHIVE'].append(os.path.getsize(path) if audio is not None else 0)
+
+    def close(self):
+        """ waits until the queued transcripts are archived """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.fdesc.close()
@@ -0,0 +1,143 @@
+import json
+import time
+import asyncio
+import logging
+import websockets
+import numpy as np
+from python.Codec import encode
+from python.Hyp import Hyp
+from python.StreamMic import StreamMic
+
+class AsyncStreamMic(StreamMic):
+
+    def __init__(self, *args, url_ws='ws://127.0.0.1:5001', **kwargs):
+        """
+        StreamMic using the websocket streaming endpoint of the server: audio is pushed as soon as captured, speech windows are
+        sent for decoding every sleep_ms (when no decoding is pending) and words are received as soon as the server decodes them.
+        Same arguments as StreamMic plus:
+        url_ws: address of the websocket endpoint
+        """
+        if kwargs.get('final'):
+            raise ValueError('final re-decoding is only available with http requests')
+        super().__init__(*args, **kwargs)
+        self.url_ws = url_ws
+        if self.encoding == 'json':
+            self.encoding = 'float32'
+        self.audio_start = 0
+        self.queued = 0
+        self.pending = None
+        self.partial = []
+
+    def __call__(self):
+        self.transcripts = []
+        asyncio.run(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        outbox = asyncio.Queue()
+
+        def enqueue(block):
+            """ runs in the event loop: audio is queued for sending in capture order """
+            self.queued += len(block)
+            outbox.put_nowait(block)
+
+        def callback(indata, frames, time, status):
+            """ audio source callback (audio thread): stores the block and hands it to the event loop """
+            if status:
+                logging.error('callback error: {}'.format(status))
+            block = indata[:, 0].copy()
+            self.audio.append(block)
+            loop.call_soon_threadsafe(enqueue, block)
+
+        async with websockets.connect(self.url_ws, max_size=None) as ws:
+            await ws.send(json.dumps({'type': 'open', 'language': self.language, 'beam_size': self.beam_size, 'task': self.task, 'model': self.model, 'compute_type': self.compute_type, 'encoding': self.encoding, 'offset': 0}))
+            opened = json.loads(await ws.recv())
+            if opened.get('type') != 'opened':
+                raise SystemExit('cannot open stream: {}'.format(opened))
+            logging.info('stream {} opened'.format(opened['session']))
+            with self.source.open(callback):
+                """ runs until the connection is closed or the source is replayed (the analyser then returns) """
+                tasks = [asyncio.create_task(self.sender(ws, outbox)), asyncio.create_task(self.receiver(ws, outbox)), asyncio.create_task(self.analyser(outbox))]
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+                for task in done:
+                    task.result()
+
+    async def sender(self, ws, outbox):
+        """ sends queued messages in order, consecutive audio blocks are sent in one binary frame """
+        while True:
+            items = [await outbox.get()]
+            while not outbox.empty():
+                items.append(outbox.get_nowait())
+            blocks = []
+            for item in items + [None]:
+                if isinstance(item, np.ndarray):
+                    blocks.append(item)
+                    continue
+                if len(blocks):
+                    data = encode(np.concatenate(blocks), self.encoding, self.sample_rate)
+                    self.stats['bytes_SENT'].append(len(data))
+                    await ws.send(data)
+                    blocks = []
+                if item is not None:
+                    await ws.send(json.dumps(item))
+
+    async def analyser(self, outbox):
+        """ every sleep_ms runs the VAD over the audio not yet transcribed and asks for the decoding of its speech """
+        loop = asyncio.get_running_loop()
+        while self.source.active() or self.pending is not None:
+            await asyncio.sleep(self.sleep_ms / 1000 / self.source.speed)
+            if self.pending is not None:
+                continue
+            """ only audio already queued for sending is analysed, so the server has it when the decode message arrives """
+            audio_end = self.queued
+            audio_start, vad, speech_start, speech_end = await loop.run_in_executor(None, self.detect_speech, self.audio_start, audio_end)
+            if vad is None:
+                self.move_start(outbox, audio_start)
+                continue
+            self.audio_start = audio_start
+            self.pending = {'vad': vad, 'window': [speech_start, speech_end], 'tic': time.time()}
+            self.stats['time_speech'].append((speech_end - speech_start)/self.sample_rate)
+            history = self.transcripts[-1]['str'] if len(self.transcripts) else None
+            decode = {'type': 'decode', 'start': speech_start, 'end': speech_end, 'history': history}
+            if self.vad_mode == 'client':
+                decode['speech_chunks'] = self.request_chunks(vad, speech_start, speech_end)
+            outbox.put_nowait(decode)
+
+    async def receiver(self, ws, outbox):
+        """ handles the results pushed by the server """
+        async for message in ws:
+            msg = json.loads(message)
+            if msg['type'] == 'language':
+                self.partial = []
+            elif msg['type'] == 'word':
+                if self.pending is not None and len(self.partial) == 0:
+                    self.stats['time_FIRSTWORD'].append(time.time() - self.pending['tic'])
+                self.partial.append(msg['word'][2])
+                print("hyp: {}".format(''.join(self.partial).strip()), end='\n' if logging.root.level == logging.INFO else '\r')
+            elif msg['type'] == 'hyp':
+                pending, self.pending = self.pending, None
+                if pending is None:
+                    continue
+                self.stats['time_ASR'].append(time.time() - pending['tic'])
+                start, end = msg['window']
+                hyp = Hyp(msg, start, end)
+                self.move_start(outbox, self.handle_hyp(hyp, pending['vad'], self.audio_start))
+            elif msg['type'] in ('coalesced', 'shed', 'error'):
+                logging.warning('decoding of {} failed: {} {}'.format(msg.get('window'), msg['type'], msg.get('error')))
+                self.pending = None
+                if msg['type'] == 'shed':
+                    self.stats['n_SHED'].append(1)
+                    self.sleep_ms = min(self.max_sleep_ms, 2 * self.sleep_ms)
+            elif msg['type'] == 'final':
+                logging.info('final [{}, {}): {}'.format(msg['start'], msg['end'], msg['text']))
+
+    def move_start(self, outbox, audio_start):
+        """ commits audio_start locally and on the server (the last transcript is sent along) """
+        if audio_start == self.audio_start:
+            return
+        self.audio_start = audio_start
+        self.commit(audio_start)
+        t = self.transcripts[-1] if len(self.transcripts) and self.transcripts[-1]['end'] == audio_start else None
+        outbox.put_nowait({'type': 'commit', 'offset': audio_start, 'start': t['start'] if t else None, 'text': t['str'] if t else None})
@@ -0,0 +1,100 @@
+import time
+import logging
+import threading
+import numpy as np
+import soundfile as sf
+import sounddevice as sd
+
+class MicSource():
+
+    def __init__(self, channels=1, block_size=1024, sample_rate=16000, device=None):
+        """
+        Audio captured from the microphone (device: id or name, default microphone when None): open(callback) returns the 
+        sd.InputStream calling callback with each block of block_size frames. The source clock is the wall clock
+        """
+        self.device = device if device is not None else sd.default.device[0] if channels == 1 else sd.default.device[1]
+        self.channels = channels
+        self.block_size = block_size
+        self.sample_rate = sample_rate
+        self.speed = 1.0
+
+    def open(self, callback):
+        return sd.InputStream(
+            device=self.device,
+            channels=self.channels,
+            callback=callback,
+            blocksize=self.block_size,
+            samplerate=self.sample_rate)
+
+    def active(self):
+        """ the microphone never runs out of audio """
+        return True
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, ms):
+        sd.sleep(ms)
+
+
+class FileSource():
+
+    def __init__(self, path, channels=1, block_size=1024, sample_rate=16000, speed=1.0, tail_sec=2.0):
+        """
+        Replays an audio file (any format read by soundfile: wav, flac, ...) through the same callback as the microphone,
+        blocks are delivered at speed times the real-time rate. The source clock runs speed times faster than the wall
+        clock (so that time_ms and sleep(ms) intervals refer to the audio stream). Once the file (followed by tail_sec of
+        silence, to let the last transcript end) is replayed, the source is not active anymore
+        Params:
+        path: the audio file
+        speed: replay rate (1.0: real time)
+        tail_sec: silence appended to the file
+        """
+        data, file_rate = sf.read(path, dtype='float32', always_2d=True)
+        if file_rate != sample_rate:
+            logging.warning('{}: resampling from {} to {} Hz'.format(path, file_rate, sample_rate))
+            positions = np.arange(int(len(data) * sample_rate / file_rate)) * file_rate / sample_rate
+            data = np.stack([np.interp(positions, np.arange(len(data)), data[:, c]) for c in range(data.shape[1])], axis=1).astype(np.float32)
+        self.data = np.concatenate((data, np.zeros((int(tail_sec * sample_rate), data.shape[1]), dtype=np.float32)))
+        self.path = path
+        self.channels = channels
+        self.block_size = block_size
+        self.sample_rate = sample_rate
+        self.speed = speed
+        self.duration = len(data) / sample_rate
+        self.finished = threading.Event()
+        self.stopped = threading.Event()
+        self.callback = None
+
+    def open(self, callback):
+        self.callback = callback
+        return self
+
+    def __enter__(self):
+        self.finished.clear()
+        self.stopped.clear()
+        threading.Thread(target=self.replay, name='replay', daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+
+    def replay(self):
+        """ delivers the blocks on schedule (sleeping until each block is due, so delays do not accumulate) """
+        start = time.time()
+        for i, pos in enumerate(range(0, len(self.data), self.block_size)):
+            due = start + i * self.block_size / self.sample_rate / self.speed
+            if self.stopped.wait(max(0, due - time.time())):
+                return
+            block = self.data[pos:pos+self.block_size]
+            self.callback(block, len(block), None, None)
+        self.finished.set()
+
+    def active(self):
+        return not self.finished.is_set()
+
+    def time(self):
+        return time.time() * self.speed
+
+    def sleep(self, ms):
+        time.sleep(ms / 1000 / self.speed)
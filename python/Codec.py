@@ -0,0 +1,59 @@
+import io
+import json
+import numpy as np
+import soundfile as sf
+from urllib.parse import quote, unquote
+
+""" encodings accepted for binary audio requests (X-Audio-Encoding header) """
+ENCODINGS = ('float32', 'int16', 'flac')
+
+def encode(audio, encoding='float32', sample_rate=16000):
+    """
+    Encode an audio wave into the bytes of a binary request body
+
+    Params:
+    audio: numpy.ndarray dtype=float32 containing the audio wave (values in [-1, 1])
+    encoding: float32 (raw little-endian float32 PCM), int16 (raw little-endian int16 PCM) or flac (lossless w.r.t. int16 PCM)
+    sample_rate: the sample rate of the audio wave
+    Returns:
+    bytes
+    """
+    if encoding == 'float32':
+        return np.ascontiguousarray(audio, dtype='<f4').tobytes()
+    if encoding == 'int16':
+        return (np.clip(audio, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+    if encoding == 'flac':
+        buf = io.BytesIO()
+        sf.write(buf, audio, sample_rate, format='FLAC', subtype='PCM_16')
+        return buf.getvalue()
+    raise ValueError('unknown audio encoding: {}'.format(encoding))
+
+def decode(body, encoding='float32', sample_rate=16000):
+    """
+    Decode the bytes of a binary request body into an audio wave
+
+    Params:
+    body: bytes received
+    encoding: one of ENCODINGS
+    sample_rate: the sample rate expected by the model
+    Returns:
+    numpy.ndarray dtype=float32 (zero-copy, read-only view of body when encoding is float32)
+    """
+    if encoding == 'float32':
+        return np.frombuffer(body, dtype='<f4')
+    if encoding == 'int16':
+        return np.frombuffer(body, dtype='<i2').astype(np.float32) / 32768.0
+    if encoding == 'flac':
+        data, sr = sf.read(io.BytesIO(body), dtype='float32')
+        if sr != sample_rate:
+            raise ValueError('flac audio sampled at {} Hz, expected {} Hz'.format(sr, sample_rate))
+        return data
+    raise ValueError('unknown audio encoding: {}'.format(encoding))
+
+def encode_options(options):
+    """ options dict sent in the X-Options header (json, percent-encoded since headers are latin-1 only) """
+    return quote(json.dumps(options))
+
+def decode_options(header):
+    """ inverse of encode_options """
+    return json.loads(unquote(header)) if header else {}
@@ -2,21 +2,58 @@ import logging
 
 class Hyp():
 
-    def __init__(self, response_json, start, end):
-        """ response_json is like: {'transcript': {'hyp': [[0.0, 0.28, ' Ouf'], [0.28, 0.54, ' !']], 'language': 'fr', 'language_probability': 1}} """
+    def __init__(self, response_json, start, end, prefix=''):
+        """ 
+        response_json is like: {'transcript': {'hyp': [[0.0, 0.28, ' Ouf'], [0.28, 0.54, ' !']], 'language': 'fr', 'language_probability': 1}} 
+        prefix: printed before the hypothesis (name of the stream)
+        """
+        self.prefix = prefix
         self.start = start
         self.end = end
         self.language = None
         self.language_probability = None
         self.hyp = None
+        self.complete = True
+        """ the hypothesis of a previous request reused for an unchanged window (no new decoding) """
+        self.reused = False
+        """ speech chunks of the window found by the server VAD (positions relative to start) """
+        self.speech_chunks = None
         if 'transcript' in response_json:
             t = response_json['transcript']
             if 'language' in t and 'language_probability' in t and 'hyp' in t:
                 self.language = t['language']
                 self.language_probability = t['language_probability']
                 self.hyp = t['hyp']
+                self.speech_chunks = t.get('speech_chunks')
                 if len(self.hyp):
-                    print("hyp: {}".format(str(self)), end='\n' if logging.root.level == logging.INFO else '\r')
+                    print(self.prefix + "hyp: {}".format(str(self)), end='\n' if logging.root.level == logging.INFO else '\r')
+
+    def update(self, event):
+        """ 
+        Consumes an event of a streamed response: {'type': 'language', ...}, {'type': 'word', 'word': [start, end, word]} 
+        or the complete transcript {'type': 'hyp', 'transcript': ...}. Returns True when the hypothesis is complete
+        """
+        if event['type'] == 'language':
+            self.language = event['language']
+            self.language_probability = event['language_probability']
+            self.hyp = []
+        elif event['type'] == 'word':
+            if self.hyp is None:
+                self.hyp = []
+            self.hyp.append(event['word'])
+            print(self.prefix + "hyp: {}".format(str(self)), end='\n' if logging.root.level == logging.INFO else '\r')
+        elif event['type'] == 'hyp':
+            t = event['transcript']
+            self.language = t['language']
+            self.language_probability = t['language_probability']
+            self.hyp = t['hyp']
+            self.speech_chunks = t.get('speech_chunks')
+            self.complete = True
+        else:
+            logging.warning('streamed response {}: {}'.format(event['type'], event.get('error')))
+            self.hyp = None
+            self.complete = True
+        return self.complete
 
     def __len__(self):
         return len(self.hyp) if self.hyp is not None else 0
@@ -43,5 +80,5 @@ class Hyp():
 
     def remove_after_token_n(self, n, sample_rate):
         assert len(self.hyp) > n+1
-        self.end = self.start + sample_rate * int(self.hyp[n][1]+self.hyp[n+1][0])//2
+        self.end = self.start + int(sample_rate * (self.hyp[n][1]+self.hyp[n+1][0]) / 2)
         self.hyp = self.hyp[:n+1]
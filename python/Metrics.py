@@ -0,0 +1,196 @@
+import os
+import time
+import random
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+
+""" default buckets (seconds) of latency histograms """
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value)) if value not in (float('inf'), float('-inf')) else ('+Inf' if value > 0 else '-Inf')
+
+
+class Counter():
+
+    kind = 'counter'
+
+    def __init__(self, name, help, lock):
+        self.name = name
+        self.help = help
+        self.lock = lock
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, lock, function=None):
+        """ the value of a gauge is set (set/inc/dec) or read from function when rendered """
+        super().__init__(name, help, lock)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+        return super().samples()
+
+
+class Histogram():
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, lock, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.lock = lock
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """ observes the time (seconds) spent in the with block """
+        tic = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - tic, **labels)
+
+    def samples(self):
+        samples = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', key + (('le', format_value(bound)),), cumulative))
+            samples.append((self.name + '_sum', key, total))
+            samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+class Metrics():
+
+    def __init__(self):
+        """
+        Registry of the server metrics, rendered in the Prometheus text exposition format (GET /metrics).
+        counter(), gauge() and histogram() return the metric registered with that name (created the first time)
+        """
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, cls, name, help, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, self.lock, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self.register(Counter, name, help)
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge, name, help, function=function)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            if isinstance(metric, Gauge) and metric.function is not None:
+                """ the function may take other locks """
+                samples = metric.samples()
+            else:
+                with self.lock:
+                    samples = metric.samples()
+            for name, labels, value in samples:
+                lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class SampledProfiler():
+
+    def __init__(self, rate=0.0, slow_ms=1000, directory=None):
+        """
+        Profiles (cProfile) a random sample of the requests: the profile of a sampled request slower than slow_ms is logged
+        (top functions by cumulative time) and saved in directory (pstats file) when given
+        Params:
+        rate: fraction of the requests profiled (0: disabled)
+        slow_ms: minimum duration (ms) of the requests reported
+        directory: (optional) where the profiles are saved
+        """
+        self.rate = rate
+        self.slow_ms = slow_ms
+        self.directory = directory
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        """ profiles the with block (runs in the calling thread only) """
+        if self.rate <= 0 or random.random() >= self.rate:
+            yield
+            return
+        profile = cProfile.Profile()
+        tic = time.time()
+        try:
+            profile.enable()
+        except ValueError:
+            """ another thread is being profiled (python >= 3.12 profiles all the threads) """
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed_ms = (time.time() - tic) * 1000
+            if elapsed_ms >= self.slow_ms:
+                self.report(profile, name, elapsed_ms)
+
+    def report(self, profile, name, elapsed_ms):
+        stats = pstats.Stats(profile)
+        if self.directory is not None:
+            fname = os.path.join(self.directory, 'profile.{}.{}.prof'.format(name, time.strftime('%Y-%m-%d_%H:%M:%S')))
+            stats.dump_stats(fname)
+            logging.warning('slow {} ({:.0f} ms) profiled in {}'.format(name, elapsed_ms, fname))
+        top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:10]
+        logging.warning('slow {} ({:.0f} ms), top functions by cumulative time:\n{}'.format(name, elapsed_ms, '\n'.join(
+            '\t{:.3f}s\t{}\t{}:{}({})'.format(ct, nc, fname, line, func) for (fname, line, func), (cc, nc, tt, ct, callers) in top)))
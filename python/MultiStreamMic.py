@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import logging
+import threading
+import contextlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from python.StreamMic import StreamMic, connection_pool, print_stat_lines
+from python.AudioSource import MicSource
+from python.VAD import BatchStreamVAD
+
+class MultiStreamMic():
+
+    def __init__(self, task='transcribe', beam_size=5, channels=2, block_size=1024, sample_rate=16000, sleep_ms=500, *args, devices=None, source=None, **kwargs):
+        """
+        Transcribes several audio streams from one process: the channels of a multichannel device (or of the file replayed by
+        source) or the first channel of each of several devices. Each stream has its own StreamMic (capture buffer, audio_start,
+        transcripts and stats). Every sleep_ms the VAD of all the streams runs in one batched call and the ASR requests of the
+        streams run concurrently, sharing the server pool and its keep-alive connections.
+        Same arguments as StreamMic (channels is the number of streams) plus:
+        devices: (optional) input devices (ids or names) captured, one stream each, instead of the channels of the default device
+        """
+        self.streams = len(devices) if devices else channels
+        self.block_size = block_size
+        self.sample_rate = sample_rate
+        self.sleep_ms = sleep_ms
+        """ sources and the streams fed by their channels """
+        if devices:
+            self.sources = [(MicSource(1, block_size, sample_rate, device), [i]) for i, device in enumerate(devices)]
+        else:
+            self.sources = [(source if source is not None else MicSource(channels, block_size, sample_rate), list(range(channels)))]
+        """ the first source is the clock of the analysis loop """
+        self.source = self.sources[0][0]
+        if kwargs.pop('inflight', 0):
+            logging.warning('pipelined requests (inflight) are not available with several streams')
+        """ the VAD of the streams is run by the batched streaming VAD """
+        kwargs['stream_vad'] = False
+        self.stats_sec = kwargs.pop('stats_sec', 0)
+        """ the transcripts of each stream are archived in a subdirectory named after the stream """
+        archive_dir = kwargs.pop('archive_dir', None)
+        http = connection_pool(self.streams)
+        self.mics = []
+        for i in range(self.streams):
+            self.mics.append(StreamMic(
+                task,
+                beam_size,
+                1,
+                block_size,
+                sample_rate,
+                sleep_ms,
+                *args,
+                name='ch{}'.format(i),
+                source=self.source,
+                servers=self.mics[0].servers if i else None,
+                http=http,
+                archive_dir=os.path.join(archive_dir, 'ch{}'.format(i)) if archive_dir is not None else None,
+                **kwargs))
+        self.servers = self.mics[0].servers
+        self.vad = BatchStreamVAD(self.streams, sample_rate) if self.mics[0].vad_mode != 'server' else None
+        self.executor = ThreadPoolExecutor(max_workers=self.streams, thread_name_prefix='stream')
+        self.stats = defaultdict(list)
+
+    def __call__(self):
+        for m in self.mics:
+            m.transcripts = []
+        self.servers.start()
+        if self.stats_sec > 0:
+            threading.Thread(target=self.dump_stats, name='stats', daemon=True).start()
+        with contextlib.ExitStack() as stack:
+            for source, streams in self.sources:
+                stack.enter_context(source.open(self.callback(streams)))
+            """ infinite loop (stopped using [Ctrl+c]) or until the sources are replayed """
+            tic = self.source.time()
+            while any(source.active() for source, _ in self.sources):
+                """ with adaptive ticks, the stream needing the shortest interval sets it """
+                tic = self.wait_tick(tic, min(m.interval_ms for m in self.mics))
+                tic_TICK = time.time()
+                self.analyse_audio()
+                self.stats['time_TICK'].append(time.time() - tic_TICK)
+
+    def callback(self, streams):
+        """ callback of a source: channel i of the blocks captured is appended to the audio of streams[i] """
+        def callback(indata, frames, time, status):
+            if status:
+                logging.error('callback error: {}'.format(status))
+            for i, stream in enumerate(streams):
+                self.mics[stream].audio.append(indata[:, min(i, indata.shape[1]-1)])
+        return callback
+
+    """ the ticks and the periodic stats are those of StreamMic (source clock, stats_sec) """
+    wait_tick = StreamMic.wait_tick
+    dump_stats = StreamMic.dump_stats
+
+    def analyse_audio(self):
+        """ 
+        runs the energy gates, the VAD of all the streams in one batch, then the analysis of each stream (ASR requests) 
+        concurrently
+        """
+        windows = []
+        speech = [True] * self.streams
+        for i, m in enumerate(self.mics):
+            start, end = m.clamp_start(m.audio_start), len(m.audio)
+            """ the energy gates run first so that the batched VAD skips the audio they reject """
+            if m.energy_gate is not None:
+                start, speech[i] = m.gate(start, end)
+            windows.append((m.audio, start, end if speech[i] else start))
+        speech_chunks = [None] * self.streams
+        if self.vad is not None:
+            tic_VAD = time.time()
+            speech_chunks = self.vad(windows)
+            self.stats['time_VAD'].append(time.time() - tic_VAD)
+        futures = [self.executor.submit(m.analyse_audio, start, end, chunks, True) if s else None for m, (_, start, end), chunks, s in zip(self.mics, windows, speech_chunks, speech)]
+        for m, (_, start, _), future in zip(self.mics, windows, futures):
+            if future is None:
+                """ no speech passed the gate of the stream: nothing to analyse """
+                m.interval_ms = m.tick_interval(None)
+                m.advance_start(start)
+            else:
+                m.advance_start(future.result())
+
+    @property
+    def transcripts(self):
+        """ transcripts of all the streams (with their stream name), ordered by start """
+        return sorted((dict(t, stream=m.name) for m in self.mics for t in m.transcripts), key=lambda t: t['start'])
+
+    def close(self):
+        for m in self.mics:
+            m.close()
+        self.executor.shutdown(wait=False)
+
+    def print_stats(self):
+        for m in self.mics:
+            m.print_stats(servers=False)
+        print("Stats of the {} streams (name sum count mean p50 p95 p99): time_VAD of the batches".format(self.streams), file=sys.stderr)
+        print_stat_lines(self.stats, sys.stderr)
+        self.servers.print_stats(sys.stderr)
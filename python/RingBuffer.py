@@ -0,0 +1,73 @@
+import threading
+import numpy as np
+
+class RingBuffer():
+
+    def __init__(self, capacity):
+        """
+        Fixed-size buffer of the audio captured. Samples are indexed by their absolute position in the stream:
+        len(buffer) is the number of samples captured so far and buffer[start:end] returns a copy of the samples in [start, end).
+        Only the last capacity samples are kept in memory.
+        Params:
+        capacity: number of samples kept in memory
+        """
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.end = 0
+        self.released = 0
+        self.overflows = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.end
+
+    def append(self, data):
+        """
+        Appends data (numpy.ndarray dtype=float32 with one dimension). Called from the audio thread: costs O(len(data))
+        """
+        n = len(data)
+        with self.lock:
+            if self.end + n - self.released > self.capacity:
+                """ unreleased samples are overwritten """
+                self.overflows += 1
+                self.released = self.end + n - self.capacity
+            pos = self.end % self.capacity
+            if pos + n <= self.capacity:
+                self.buffer[pos:pos+n] = data
+            else:
+                k = self.capacity - pos
+                self.buffer[pos:] = data[:k]
+                self.buffer[:n-k] = data[k:]
+            self.end += n
+
+    def oldest(self):
+        """ position of the oldest sample still available (neither released nor overwritten) """
+        with self.lock:
+            return max(self.released, self.end - self.capacity)
+
+    def __getitem__(self, key):
+        """ buffer[start:end] (absolute positions) returns a copy of the samples """
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('RingBuffer only supports contiguous slices')
+        with self.lock:
+            start, end, _ = key.indices(self.end)
+            end = max(start, end)
+            memory_start = max(0, self.end - self.capacity)
+            if start < memory_start:
+                raise IndexError('samples [{}, {}) no longer available (in memory since {})'.format(start, end, memory_start))
+            return self._read(start, end)
+
+    def _read(self, start, end):
+        pos = start % self.capacity
+        n = end - start
+        if pos + n <= self.capacity:
+            return self.buffer[pos:pos+n].copy()
+        return np.concatenate((self.buffer[pos:], self.buffer[:n-(self.capacity-pos)]))
+
+    def release(self, offset):
+        """
+        Samples before offset are not needed anymore (they may be overwritten without counting an overflow).
+        Called from the analysis thread
+        """
+        with self.lock:
+            self.released = max(self.released, min(offset, self.end))
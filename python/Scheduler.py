@@ -0,0 +1,195 @@
+import time
+import logging
+import threading
+
+class Coalesced(Exception):
+    """ the request was superseded by a newer request of the same stream """
+
+class Shed(Exception):
+    """ the request cannot be served before its deadline """
+
+
+class Job():
+
+    def __init__(self, audio, stream=None, window=None, deadline=None, **options):
+        """
+        A transcription request waiting in the scheduler queue
+        Params:
+        audio: the audio wave to transcribe
+        stream: (optional) identifier of the client stream sending the request
+        window: (optional) [start, end) positions of audio in the stream
+        deadline: (optional) time (time.time()) after which the result is useless to the client
+        options: the remaining StreamASR.__call__ arguments (language, history, beam_size, task, model_size, compute_type)
+        """
+        self.audio = audio
+        self.stream = stream
+        self.window = window
+        self.deadline = deadline
+        self.options = options
+        self.submitted = time.time()
+        self.started = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+
+    def key(self):
+        """ requests with the same key can be decoded together """
+        return (self.options.get('beam_size'), self.options.get('task'), self.options.get('language'), self.options.get('model_size'), self.options.get('compute_type'))
+
+    def superseded_by(self, job):
+        """ job is a newer request of the same stream whose window contains the window of self """
+        return self.stream is not None and job.stream == self.stream and self.window is not None and job.window is not None \
+            and job.window[0] <= self.window[0] and job.window[1] >= self.window[1]
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Scheduler():
+
+    def __init__(self, replicas, max_batch_size=1, max_wait_ms=0, sample_rate=16000, name='main', metrics=None):
+        """
+        Queue of transcription requests served by a pool of model replicas (StreamASR). Each replica has a worker thread that
+        takes the oldest pending request plus the compatible ones (same beam_size, task and language) arrived within max_wait_ms,
+        up to max_batch_size, and decodes them together.
+        Requests of a stream superseded by a newer request are dropped (queued) or cancelled (running), requests that cannot
+        meet their deadline are shed
+        Params:
+        replicas: list of StreamASR
+        max_batch_size: maximum number of requests decoded together by a replica
+        max_wait_ms: maximum time (ms) the oldest request waits for compatible requests to fill the batch
+        sample_rate: the sample rate of the audio received (to estimate decoding times)
+        name: label of the scheduler metrics
+        metrics: (optional) Metrics registry receiving the queue wait and decoding times, the requests by outcome and the queue sizes
+        """
+        self.replicas = replicas
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_ms / 1000
+        self.sample_rate = sample_rate
+        self.queue = []
+        self.running = []
+        self.counts = {'served': 0, 'coalesced': 0, 'shed': 0, 'failed': 0}
+        self.name = name
+        self.metrics = metrics
+        if metrics is not None:
+            self.time_queue = metrics.histogram('asr_queue_wait_seconds', 'Time requests wait in the scheduler queue')
+            self.time_batch = metrics.histogram('asr_batch_seconds', 'Time decoding the batches of requests (see asr_encode_seconds and asr_decode_seconds per request)')
+            self.jobs = metrics.counter('asr_jobs_total', 'Requests handled by the scheduler by outcome')
+            self.jobs_queued = metrics.gauge('asr_jobs_queued', 'Requests waiting in the scheduler queue')
+            self.jobs_running = metrics.gauge('asr_jobs_running', 'Requests being decoded')
+        """ decoding time per second of audio (moving average) """
+        self.rtf = None
+        self.cond = threading.Condition()
+        for i, replica in enumerate(replicas):
+            threading.Thread(target=self.worker, args=(replica,), name='replica-{}'.format(i), daemon=True).start()
+        logging.info('Scheduler ready: {} replicas, max_batch_size={} max_wait_ms={}'.format(len(replicas), max_batch_size, max_wait_ms))
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __call__(self, audio, **options):
+        """ submits a request and waits for its result (same arguments and result as StreamASR.__call__), raises Coalesced or Shed """
+        return self.submit(Job(audio, **options)).wait()
+
+    def count(self, outcome):
+        """ called with self.cond held """
+        self.counts[outcome] += 1
+        if self.metrics is not None:
+            self.jobs.inc(scheduler=self.name, outcome=outcome)
+            self.jobs_queued.set(len(self.queue), scheduler=self.name)
+            self.jobs_running.set(len(self.running), scheduler=self.name)
+
+    def service_time(self, job):
+        return len(job.audio) / self.sample_rate * (self.rtf or 0)
+
+    def estimated_wait(self):
+        """ estimated time (seconds) a new request waits before being decoded """
+        with self.cond:
+            return sum(self.service_time(job) for job in self.queue) / len(self.replicas)
+
+    def submit(self, job):
+        with self.cond:
+            for old in self.queue + self.running:
+                if old.superseded_by(job) and not old.cancelled.is_set():
+                    old.cancelled.set()
+                    if old in self.queue:
+                        self.queue.remove(old)
+                        self.count('coalesced')
+                        old.finish(error=Coalesced('superseded by a newer request of stream {}'.format(job.stream)))
+            if job.deadline is not None and time.time() + sum(self.service_time(j) for j in self.queue) / len(self.replicas) + self.service_time(job) > job.deadline:
+                self.count('shed')
+                job.finish(error=Shed('deadline cannot be met'))
+                return job
+            self.queue.append(job)
+            if self.metrics is not None:
+                self.jobs_queued.set(len(self.queue), scheduler=self.name)
+            self.cond.notify_all()
+        return job
+
+    def next_batch(self):
+        """ blocks until a batch of compatible jobs is ready, then removes it from the queue """
+        with self.cond:
+            while True:
+                now = time.time()
+                for job in [job for job in self.queue if job.deadline is not None and now + self.service_time(job) > job.deadline]:
+                    self.queue.remove(job)
+                    self.count('shed')
+                    job.finish(error=Shed('deadline expired while queued'))
+                if len(self.queue) == 0:
+                    self.cond.wait()
+                    continue
+                key = self.queue[0].key()
+                compatible = [job for job in self.queue if job.key() == key][:self.max_batch_size]
+                remaining = self.queue[0].submitted + self.max_wait_sec - now
+                if len(compatible) < self.max_batch_size and remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                for job in compatible:
+                    self.queue.remove(job)
+                    job.started = now
+                    if self.metrics is not None:
+                        self.time_queue.observe(now - job.submitted, scheduler=self.name)
+                self.running += compatible
+                if self.metrics is not None:
+                    self.jobs_queued.set(len(self.queue), scheduler=self.name)
+                    self.jobs_running.set(len(self.running), scheduler=self.name)
+                return compatible
+
+    def worker(self, replica):
+        while True:
+            batch = self.next_batch()
+            tic = time.time()
+            logging.info('batch of {} requests, queue wait {}'.format(len(batch), ['{:.3f}'.format(tic-job.submitted) for job in batch]))
+            try:
+                results = replica.batch([(job.audio, dict(job.options, cancel=job.cancelled.is_set)) for job in batch])
+            except Exception as e:
+                logging.exception('batch failed')
+                results = [e] * len(batch)
+            elapsed = time.time() - tic
+            if self.metrics is not None:
+                self.time_batch.observe(elapsed, scheduler=self.name)
+            with self.cond:
+                audio_sec = sum(len(job.audio) for job in batch) / self.sample_rate
+                if audio_sec > 0 and not isinstance(results[0], Exception):
+                    rtf = elapsed / audio_sec
+                    self.rtf = rtf if self.rtf is None else 0.8 * self.rtf + 0.2 * rtf
+                for job, result in zip(batch, results):
+                    self.running.remove(job)
+                    if isinstance(result, Exception):
+                        self.count('failed')
+                        job.finish(error=result)
+                    elif job.cancelled.is_set():
+                        self.count('coalesced')
+                        job.finish(error=Coalesced('superseded by a newer request of stream {}'.format(job.stream)))
+                    else:
+                        self.count('served')
+                        job.finish(result=result)
@@ -0,0 +1,135 @@
+import random
+import logging
+import threading
+import requests
+
+class Server():
+
+    def __init__(self, url):
+        """
+        State of an ASR server of the pool
+        Params:
+        url: base address of the server (http://host:port)
+        """
+        self.url = url
+        self.outstanding = 0
+        """ moving average of the response time (seconds), sum of the response times (mean) """
+        self.latency = None
+        self.latency_sum = 0.0
+        self.latencies = 0
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+        self.ejected = False
+        """ share of the picks of a recovering server (starts low and doubles after each success) """
+        self.weight = 1.0
+
+    def score(self, routing):
+        """ the candidate server with the lowest score receives the next request """
+        if routing == 'latency':
+            return (self.outstanding + 1) * (self.latency or 0)
+        return self.outstanding + 1
+
+
+class ServerPool():
+
+    def __init__(self, urls, routing='least', health_ms=2000, timeout=2, recovery_weight=0.125):
+        """
+        Pool of ASR servers used by a client. Requests are routed to the server with the least outstanding requests
+        (routing='least') or with the lowest expected latency (routing='latency': outstanding requests times the moving
+        average of its response time). Servers failing a request are ejected until a health check (GET /health) succeeds,
+        they then receive a recovery_weight share of the picks, which doubles after each request served.
+        Params:
+        urls: list of base addresses of the servers (http://host:port)
+        routing: 'least' or 'latency'
+        health_ms: interval (ms) between health checks (0: ejected servers are only retried when no other server is available)
+        timeout: timeout (seconds) of health checks
+        recovery_weight: initial share of the traffic of a server coming back
+        """
+        self.servers = [Server(url) for url in urls]
+        self.routing = routing
+        self.health_ms = health_ms
+        self.timeout = timeout
+        self.recovery_weight = recovery_weight
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def __len__(self):
+        return len(self.servers)
+
+    def start(self):
+        """ starts the health checks thread """
+        if self.health_ms > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self.health_checks, name='health', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """ stops the health checks thread """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def pick(self, exclude=()):
+        """
+        Returns the server that should receive the next request (its outstanding requests are incremented, call done()
+        once answered) or None when all the servers are excluded. Ejected servers are only picked when no other is available
+        """
+        with self.lock:
+            candidates = [s for s in self.servers if s not in exclude]
+            if len(candidates) == 0:
+                return None
+            available = [s for s in candidates if not s.ejected] or candidates
+            """ a recovering server receives the pick when drawn, with probability weight """
+            drawn = [s for s in available if s.weight < 1.0 and random.random() < s.weight]
+            admitted = drawn or [s for s in available if s.weight >= 1.0] or available
+            """ ties are broken at random so that idle servers share the requests of a sequential client """
+            server = min(admitted, key=lambda s: (s.score(self.routing), random.random()))
+            server.outstanding += 1
+            return server
+
+    def done(self, server, latency=None, error=None):
+        """ records the result of a request sent to server: its response time or the error that ejects it """
+        with self.lock:
+            server.outstanding -= 1
+            server.requests += 1
+            if error is not None:
+                server.errors += 1
+                self.eject(server, error)
+                return
+            server.latency_sum += latency
+            server.latencies += 1
+            server.latency = latency if server.latency is None else 0.8 * server.latency + 0.2 * latency
+            server.weight = min(1.0, 2 * server.weight)
+
+    def eject(self, server, reason):
+        if not server.ejected:
+            server.ejected = True
+            server.ejections += 1
+            logging.warning('server {} ejected: {}'.format(server.url, reason))
+
+    def health_checks(self):
+        while not self.stopped.wait(self.health_ms / 1000):
+            for server in self.servers:
+                try:
+                    response = requests.get(server.url + '/health', timeout=self.timeout)
+                    healthy = response.status_code == 200
+                except requests.exceptions.RequestException:
+                    healthy = False
+                with self.lock:
+                    if healthy and server.ejected:
+                        self.restore(server)
+                    elif not healthy:
+                        self.eject(server, 'health check failed')
+
+    def restore(self, server):
+        """ server passed a health check: it comes back with a small share of the picks """
+        server.ejected = False
+        server.weight = self.recovery_weight
+        logging.warning('server {} is back'.format(server.url))
+
+    def print_stats(self, file):
+        print("server\trequests\terrors\tejections\tlatency_mean\tlatency_ewma", file=file)
+        for s in self.servers:
+            print("{}\t{}\t{}\t{}\t{:.2f}\t{:.2f}".format(s.url, s.requests, s.errors, s.ejections, s.latency_sum/max(1, s.latencies), s.latency or 0), file=file)
@@ -0,0 +1,152 @@
+import time
+import uuid
+import logging
+import threading
+import numpy as np
+
+class Session():
+
+    def __init__(self, sid, options, max_samples):
+        """
+        Server-side audio buffer of a streaming client. Samples are indexed by their absolute offset in the client stream,
+        the buffer keeps samples in [self.start, self.end)
+        Params:
+        sid: session identifier
+        options: default decoding options of the session (language, beam_size, task, ...)
+        max_samples: maximum number of samples kept (oldest samples are dropped beyond this size)
+        """
+        self.sid = sid
+        self.options = options
+        self.max_samples = max_samples
+        self.buffer = np.empty(min(max_samples, 1<<18), dtype=np.float32)
+        self.head = 0
+        self.size = 0
+        self.start = 0
+        self.last_access = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+    def append(self, data, offset):
+        """
+        Appends data, the audio wave starting at absolute position offset. Already received samples are skipped and a gap
+        (offset beyond self.end) restarts the buffer at offset
+        """
+        with self.lock:
+            self.last_access = time.time()
+            if offset > self.end:
+                self._trim(offset)
+            elif offset < self.end:
+                data = data[self.end-offset:]
+            if len(data) > self.max_samples:
+                self._trim(self.end + len(data) - self.max_samples)
+                data = data[-self.max_samples:]
+            if self.size + len(data) > self.max_samples:
+                logging.warning('session {}: buffer full, dropping {} samples'.format(self.sid, self.size + len(data) - self.max_samples))
+                self._trim(self.end + len(data) - self.max_samples)
+            if self.head + self.size + len(data) > len(self.buffer):
+                """ compact (and grow if needed) so that data fits at the end of the buffer """
+                capacity = len(self.buffer)
+                while capacity < self.size + len(data):
+                    capacity *= 2
+                buffer = np.empty(min(capacity, self.max_samples), dtype=np.float32) if capacity > len(self.buffer) else self.buffer
+                buffer[:self.size] = self.buffer[self.head:self.head+self.size]
+                self.buffer = buffer
+                self.head = 0
+            self.buffer[self.head+self.size:self.head+self.size+len(data)] = data
+            self.size += len(data)
+
+    def trim(self, offset):
+        """ releases samples before absolute position offset """
+        with self.lock:
+            self.last_access = time.time()
+            self._trim(offset)
+
+    def _trim(self, offset):
+        if offset >= self.end:
+            self.start = offset
+            self.head = 0
+            self.size = 0
+        elif offset > self.start:
+            self.head += offset - self.start
+            self.size -= offset - self.start
+            self.start = offset
+
+    def window(self, start, end):
+        """
+        Returns (start, end, audio) where audio is a copy of the samples in [start, end) clipped to the samples available
+        """
+        with self.lock:
+            self.last_access = time.time()
+            start = min(max(start, self.start), self.end)
+            end = max(min(end, self.end), start)
+            return start, end, self.buffer[self.head+start-self.start:self.head+end-self.start].copy()
+
+    @staticmethod
+    def clip_chunks(speech_chunks, requested_start, start, end):
+        """
+        Speech chunks given relative to the window requested (starting at requested_start) mapped to the window [start, end)
+        returned by window()
+        """
+        shift = start - requested_start
+        return [{'start': max(0, c['start'] - shift), 'end': min(end - start, c['end'] - shift)} 
+            for c in speech_chunks if c['end'] - shift > 0 and c['start'] - shift < end - start]
+
+    def nbytes(self):
+        return self.buffer.nbytes
+
+
+class SessionStore():
+
+    def __init__(self, ttl_sec=60, max_session_sec=120, max_sessions=500, sample_rate=16000):
+        """
+        Keeps the streaming sessions opened by clients
+        Params:
+        ttl_sec: sessions idle for more than this amount of time (seconds) are evicted
+        max_session_sec: maximum amount of audio (seconds) kept per session
+        max_sessions: maximum number of sessions opened at the same time
+        sample_rate: the sample rate of the audio received
+        """
+        self.ttl_sec = ttl_sec
+        self.max_samples = int(max_session_sec * sample_rate)
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self, options):
+        self.evict()
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                raise RuntimeError('too many sessions opened ({})'.format(len(self.sessions)))
+            session = Session(uuid.uuid4().hex, options, self.max_samples)
+            self.sessions[session.sid] = session
+        logging.info('session {} opened ({} sessions)'.format(session.sid, len(self.sessions)))
+        return session
+
+    def get(self, sid):
+        """ raises KeyError if session sid does not exist (closed or evicted) """
+        self.evict()
+        with self.lock:
+            return self.sessions[sid]
+
+    def close(self, sid):
+        with self.lock:
+            session = self.sessions.pop(sid, None)
+        if session is not None:
+            logging.info('session {} closed ({} sessions)'.format(sid, len(self.sessions)))
+        return session is not None
+
+    def evict(self):
+        """ removes sessions idle for more than ttl_sec """
+        now = time.time()
+        with self.lock:
+            expired = [sid for sid, session in self.sessions.items() if now - session.last_access > self.ttl_sec]
+            for sid in expired:
+                del self.sessions[sid]
+        for sid in expired:
+            logging.info('session {} evicted after {} seconds idle'.format(sid, self.ttl_sec))
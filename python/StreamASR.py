@@ -1,30 +1,258 @@
+import os
 import time
 import logging
+import threading
+import contextlib
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from faster_whisper import WhisperModel
+from faster_whisper.vad import VadOptions, SpeechTimestampsMap, get_speech_timestamps, collect_chunks
+
+""" approximate number of parameters of the whisper models (by size prefix) and bytes per parameter of the compute types, used to estimate the memory of a model """
+MODEL_PARAMETERS = {'tiny': 39e6, 'base': 74e6, 'small': 244e6, 'medium': 769e6, 'large': 1550e6}
+COMPUTE_TYPE_BYTES = {'int8': 1, 'int8_float16': 1, 'int8_bfloat16': 1, 'int16': 2, 'float16': 2, 'bfloat16': 2, 'float32': 4}
+
+def estimate_memory_mb(model_size, compute_type):
+    """ memory (MB) of a model: size of the converted model when model_size is a directory, otherwise estimated from its parameters """
+    path = os.path.join(model_size, 'model.bin')
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 2**20
+    parameters = next((n for prefix, n in MODEL_PARAMETERS.items() if model_size.startswith(prefix)), MODEL_PARAMETERS['large'])
+    return parameters * COMPUTE_TYPE_BYTES.get(compute_type, 2) / 2**20
+
+
+class ModelRegistry():
+
+    def __init__(self, device='auto', cpu_threads=0, num_workers=1, memory_budget_mb=0, models=None, warmup=False, metrics=None):
+        """
+        Whisper models shared by the StreamASR replicas, selected per request by (model_size, compute_type). Models are loaded
+        on first use and the least recently used ones are evicted when the models loaded exceed memory_budget_mb
+        (a model being used by a decoding is freed once the decoding ends)
+        Params:
+        device, cpu_threads, num_workers: passed to CTranslate2 (num_workers: decodings running in parallel on a model)
+        memory_budget_mb: memory (MB, estimated) of the models kept loaded (0: no limit)
+        models: (optional) model sizes that requests can select (None: any)
+        warmup: a short dummy decoding is run after loading a model (the first decodings of a model are slower)
+        metrics: (optional) Metrics registry receiving the loads and evictions
+        """
+        self.device = device
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        self.memory_budget_mb = memory_budget_mb
+        self.models = set(models) if models is not None else None
+        self.warmup = warmup
+        """ (model_size, compute_type) => {'model': WhisperModel, 'memory_mb': ..., 'loaded': event set once loaded, 'error': ..., 'uses': ..., 'last_used': ...} in LRU order """
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.loads = metrics.counter('asr_model_loads_total', 'Models loaded by model and compute type') if metrics is not None else None
+        self.evictions = metrics.counter('asr_model_evictions_total', 'Models evicted (memory budget) by model and compute type') if metrics is not None else None
+        self.time_load = metrics.histogram('asr_model_load_seconds', 'Time loading (and warming up) the models', buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)) if metrics is not None else None
+        if metrics is not None:
+            metrics.gauge('asr_models_loaded', 'Models loaded', function=lambda: len(self.loaded()))
+            metrics.gauge('asr_models_memory_mb', 'Estimated memory (MB) of the models loaded', function=self.memory_mb)
+
+    def check(self, model_size, compute_type):
+        """ raises ValueError when requests cannot select this model """
+        if self.models is not None and model_size not in self.models:
+            raise ValueError('model {} not available (available: {})'.format(model_size, ', '.join(sorted(self.models))))
+        if compute_type not in COMPUTE_TYPE_BYTES and compute_type not in ('default', 'auto'):
+            raise ValueError('unknown compute type {}'.format(compute_type))
+
+    def get(self, model_size, compute_type):
+        """ returns the model, loading it when needed (other requests of a model being loaded wait for it) """
+        self.check(model_size, compute_type)
+        key = (model_size, compute_type)
+        with self.lock:
+            entry = self.entries.get(key)
+            load = entry is None
+            if load:
+                entry = {'model': None, 'memory_mb': estimate_memory_mb(model_size, compute_type), 'loaded': threading.Event(), 'error': None, 'uses': 0, 'last_used': None}
+                self.entries[key] = entry
+            self.entries.move_to_end(key)
+            entry['uses'] += 1
+            entry['last_used'] = time.time()
+        if load:
+            self.load(key, entry)
+        entry['loaded'].wait()
+        if entry['error'] is not None:
+            raise RuntimeError('cannot load model {} ({}): {}'.format(model_size, compute_type, entry['error']))
+        return entry['model']
+
+    def load(self, key, entry):
+        model_size, compute_type = key
+        tic = time.time()
+        try:
+            entry['model'] = WhisperModel(model_size, device=self.device, compute_type=compute_type, cpu_threads=self.cpu_threads, num_workers=self.num_workers)
+            if self.warmup:
+                """ one second of silence, the segments are consumed so that the decoding actually runs """
+                list(entry['model'].transcribe(np.zeros(16000, dtype=np.float32), beam_size=1, language='en', vad_filter=False)[0])
+        except Exception as e:
+            logging.exception('cannot load model {} ({})'.format(model_size, compute_type))
+            entry['error'] = e
+            with self.lock:
+                self.entries.pop(key, None)
+            entry['loaded'].set()
+            return
+        elapsed = time.time() - tic
+        logging.info('model {} ({}, {:.0f} MB) loaded in {:.2f} seconds'.format(model_size, compute_type, entry['memory_mb'], elapsed))
+        if self.loads is not None:
+            self.loads.inc(model=model_size, compute_type=compute_type)
+            self.time_load.observe(elapsed)
+        entry['loaded'].set()
+        self.evict(key)
+
+    def evict(self, keep):
+        """ evicts the least recently used models (but keep) until the models loaded fit in the memory budget """
+        if self.memory_budget_mb <= 0:
+            return
+        with self.lock:
+            for key in list(self.entries):
+                if self.memory_mb(locked=True) <= self.memory_budget_mb:
+                    break
+                entry = self.entries[key]
+                if key == keep or not entry['loaded'].is_set():
+                    continue
+                del self.entries[key]
+                logging.info('model {} ({}) evicted'.format(*key))
+                if self.evictions is not None:
+                    self.evictions.inc(model=key[0], compute_type=key[1])
+            if self.memory_mb(locked=True) > self.memory_budget_mb:
+                logging.warning('models loaded ({:.0f} MB) exceed the memory budget ({} MB)'.format(self.memory_mb(locked=True), self.memory_budget_mb))
+
+    def memory_mb(self, locked=False):
+        if not locked:
+            with self.lock:
+                return self.memory_mb(locked=True)
+        return sum(e['memory_mb'] for e in self.entries.values())
+
+    def loaded(self):
+        """ the models loaded, least recently used first """
+        with self.lock:
+            return [{'model': key[0], 'compute_type': key[1], 'memory_mb': round(e['memory_mb'], 1), 'uses': e['uses'], 'last_used': e['last_used']}
+                for key, e in self.entries.items() if e['loaded'].is_set() and e['error'] is None]
+
 
 class StreamASR():
-    def __init__(self, model_size='tiny', device='auto', compute_type='int8'):
-        self.model = WhisperModel(model_size, device=device, compute_type=compute_type)
+    def __init__(self, model_size='tiny', device='auto', compute_type='int8', cpu_threads=0, num_workers=1, metrics=None, registry=None, profiler=None):
+        ''' 
+        model_size, compute_type: model used by the requests not selecting one
+        cpu_threads and num_workers are passed to CTranslate2: num_workers requests of a batch are decoded in parallel 
+        metrics: (optional) Metrics registry receiving the VAD, encoding and decoding times
+        registry: (optional) ModelRegistry shared with other replicas (by default the replica has its own, without memory budget).
+                  The default model is loaded on first use (see ModelRegistry.get to load it beforehand)
+        profiler: (optional) SampledProfiler of the requests decoded (in the thread decoding them)
+        '''
+        self.model_size = model_size
+        self.compute_type = compute_type
+        self.registry = registry if registry is not None else ModelRegistry(device, cpu_threads, num_workers)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+        """ whisper models work on 16 kHz audio """
+        self.sample_rate = 16000
+        """ requests with VAD run by the server / with the speech chunks given by the client, VAD time (seconds) spent / saved """
+        self.vad_stats = {'requests_vad': 0, 'requests_client_vad': 0, 'time_vad': 0.0, 'time_vad_saved': 0.0}
+        """ VAD time per second of audio (moving average, first measured over 10 seconds of silence), used to estimate the time saved """
+        tic = time.time()
+        get_speech_timestamps(np.zeros(10 * self.sample_rate, dtype=np.float32), VadOptions())
+        self.vad_rtf = (time.time() - tic) / 10
+        self.lock = threading.Lock()
+        self.time_vad = metrics.histogram('asr_vad_seconds', 'Time running the VAD over the requests audio') if metrics is not None else None
+        self.time_vad_saved = metrics.counter('asr_vad_saved_seconds_total', 'VAD time saved by the requests sending the client speech chunks (estimated)') if metrics is not None else None
+        ''' 
+        faster-whisper transcribe() is lazy: it computes the features and, when no language is given, runs the encoder over the 
+        first segment to detect the language. The segments (encoder when not run yet, then decoder) are computed as they are iterated
+        '''
+        self.time_encode = metrics.histogram('asr_encode_seconds', 'Time in transcribe() per request: features, plus the first encoder pass and language detection when no language is given') if metrics is not None else None
+        self.time_decode = metrics.histogram('asr_decode_seconds', 'Time iterating the segments per request: decoder, plus the encoder passes not run by transcribe()') if metrics is not None else None
+        self.profiler = profiler
         logging.info('StreamASR ready')
+
+    def batch(self, requests):
+        ''' 
+        Transcribes a batch of requests [(audio, options), ...] where options are the arguments of __call__.
+        faster-whisper transcribe() has no batched api: requests of the batch run concurrently on the num_workers of the model
+        '''
+        if self.executor is None or len(requests) == 1:
+            return [self(audio, **options) for audio, options in requests]
+        return list(self.executor.map(lambda r: self(r[0], **r[1]), requests))
         
-    def __call__(self, audio, language=None, history=None, beam_size=5, task='transcribe'):
-        ''' This functions calls whisper model to transcribe an audio wave. Audio is the audio wave in the form of a list containing block_size floats
+    def __call__(self, audio, language=None, history=None, beam_size=5, task='transcribe', model_size=None, compute_type=None, speech_chunks=None, cancel=None, on_event=None):
+        ''' This functions calls whisper model to transcribe an audio wave. Audio is the audio wave in the form of a list of floats or a numpy.ndarray dtype=float32 (used without copy)
         Params:
         language: speech language, 
         history: text context (prompt) for audio
         beam_size: decoding beam_size
+        model_size, compute_type: (optional) model of the registry decoding the request (default: those of the replica)
+        speech_chunks: (optional) [{'start': s, 'end': e}, ...] speech regions of audio (sample positions) found by the client VAD, 
+                       only these regions are decoded (the server VAD is skipped). The result contains the speech chunks used
+        cancel: (optional) function returning True when the result is not needed anymore (decoding stops after the current segment)
+        on_event: (optional) function called as results are produced with {'type': 'language', 'language': ..., 'language_probability': ...} 
+                  and then {'type': 'word', 'word': [start, end, word]} for each word decoded
         '''
         data = np.asarray(audio, dtype=np.float32)
         tic = time.time()
-        segments, info = self.model.transcribe(data, language=language, task=task, beam_size=beam_size, vad_filter=True, word_timestamps=True, initial_prompt=history)
-        logging.info('transcription of {} floats took {:.2f} seconds'.format(len(audio), time.time()-tic))
-        hyp = []
-        for segment in segments:
-            for word in segment.words:
-                hyp.append([word.start, word.end, word.word])
-                logging.info("\t{}\t{}\t{}".format(word.start,word.end,word.word))
-        res = {'language': info.language, 'language_probability': info.language_probability, 'hyp': hyp}
+        speech_chunks = self.vad(data, speech_chunks)
+        if len(speech_chunks) == 0:
+            logging.info('transcription of {} floats skipped: no speech'.format(len(audio)))
+            if on_event is not None:
+                on_event({'type': 'language', 'language': language, 'language_probability': 0.0})
+            return {'language': language, 'language_probability': 0.0, 'hyp': [], 'speech_chunks': []}
+        ''' the model decodes the speech chunks concatenated (as vad_filter=True does), timestamps are mapped back to audio '''
+        model = self.registry.get(model_size or self.model_size, compute_type or self.compute_type)
+        ts_map = SpeechTimestampsMap(speech_chunks, self.sample_rate)
+        with self.profiler('decode') if self.profiler is not None else contextlib.nullcontext():
+            tic_encode = time.time()
+            segments, info = model.transcribe(collect_chunks(data, speech_chunks), language=language, task=task, beam_size=beam_size, vad_filter=False, word_timestamps=True, initial_prompt=history)
+            if self.time_encode is not None:
+                self.time_encode.observe(time.time() - tic_encode)
+            if on_event is not None:
+                on_event({'type': 'language', 'language': info.language, 'language_probability': info.language_probability})
+            hyp = []
+            time_first_word = None
+            tic_decode = time.time()
+            for segment in segments:
+                if cancel is not None and cancel():
+                    logging.info('transcription cancelled')
+                    break
+                for word in segment.words:
+                    chunk_index = ts_map.get_chunk_index((word.start + word.end) / 2)
+                    hyp.append([ts_map.get_original_time(word.start, chunk_index), ts_map.get_original_time(word.end, chunk_index), word.word])
+                    if time_first_word is None:
+                        time_first_word = time.time()-tic
+                    if on_event is not None:
+                        on_event({'type': 'word', 'word': hyp[-1]})
+                    logging.info("\t{}\t{}\t{}".format(word.start,word.end,word.word))
+            if self.time_decode is not None:
+                self.time_decode.observe(time.time() - tic_decode)
+        logging.info('transcription of {} floats took {:.2f} seconds (first word after {:.2f} seconds)'.format(len(audio), time.time()-tic, time_first_word or 0))
+        res = {'language': info.language, 'language_probability': info.language_probability, 'hyp': hyp, 'speech_chunks': speech_chunks}
         logging.info(res)
         return res
 
+    def vad(self, data, speech_chunks=None):
+        ''' Returns the speech chunks of data: those given by the client or computed with the silero VAD (as vad_filter=True does) '''
+        audio_sec = len(data) / self.sample_rate
+        if speech_chunks is not None:
+            speech_chunks = [{'start': max(0, int(c['start'])), 'end': min(len(data), int(c['end']))} for c in speech_chunks]
+            speech_chunks = [c for c in speech_chunks if c['end'] > c['start']]
+            with self.lock:
+                saved = audio_sec * self.vad_rtf
+                self.vad_stats['requests_client_vad'] += 1
+                self.vad_stats['time_vad_saved'] += saved
+            if self.time_vad_saved is not None:
+                self.time_vad_saved.inc(saved)
+            logging.info('client speech chunks used, VAD time saved {:.3f} seconds'.format(saved))
+            return speech_chunks
+        tic = time.time()
+        speech_chunks = get_speech_timestamps(data, VadOptions())
+        elapsed = time.time() - tic
+        if self.time_vad is not None:
+            self.time_vad.observe(elapsed)
+        with self.lock:
+            self.vad_stats['requests_vad'] += 1
+            self.vad_stats['time_vad'] += elapsed
+            if audio_sec > 0:
+                self.vad_rtf = 0.8 * self.vad_rtf + 0.2 * elapsed / audio_sec
+        logging.info('VAD of {:.2f} seconds took {:.3f} seconds: {}'.format(audio_sec, elapsed, speech_chunks))
+        return speech_chunks
+
@@ -1,15 +1,36 @@
-import os
 import sys
 import time
 import copy
+import json
+import uuid
 import logging
+import threading
 import requests
 import numpy as np
-import sounddevice as sd
-from collections import defaultdict
-from python.Utils import save
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from python.Codec import encode, encode_options
+from python.RingBuffer import RingBuffer
+from python.ServerPool import ServerPool
+from python.AudioSource import MicSource
+from python.Archiver import Archiver
 from python.Hyp import Hyp
-from python.VAD import VAD
+from python.VAD import VAD, StreamVAD, EnergyGate
+
+def connection_pool(size):
+    """ requests session keeping up to size keep-alive connections per server """
+    http = requests.Session()
+    http.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=size))
+    http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=size))
+    return http
+
+def print_stat_lines(stats, file):
+    """ prints one line (name sum count mean p50 p95 p99) per non-empty list of stats """
+    for name, l in list(stats.items()):
+        if len(l) == 0:
+            continue
+        l = np.array(l)
+        print("{}\t{:.2f}\t{}\t{:.2f}\t{:.3f}\t{:.3f}\t{:.3f}".format(name, l.sum(), len(l), l.mean(), *np.percentile(l, [50, 95, 99])), file=file)
 
 class StreamMic():
 
@@ -27,114 +48,552 @@ class StreamMic():
         end_chars='.!?', 
         skip_ini=3, 
         skip_end=2, 
-        padding_ms=200):
+        padding_ms=200,
+        encoding='float32',
+        session=False,
+        buffer_sec=300,
+        stream_vad=False,
+        energy_gate=False,
+        deadline_ms=0,
+        stream_words=False,
+        inflight=0,
+        routing='least',
+        health_ms=2000,
+        final=False,
+        vad='both',
+        agreement=0,
+        max_window_ms=0,
+        source=None,
+        stats_sec=0,
+        model=None,
+        compute_type=None,
+        name=None,
+        servers=None,
+        http=None,
+        archive_dir=None,
+        adaptive=False,
+        min_sleep_ms=100,
+        max_sleep_ms=0):
 
-        self.mic = sd.default.device[0] if channels == 1 else sd.default.device[1]
+        """ audio is captured from the microphone unless another source (e.g. AudioSource.FileSource) is given """
+        self.name = name
+        """ transcripts printed are prefixed by the name of the stream (several streams transcribed by one process) """
+        self.prefix = '[{}] '.format(name) if name is not None else ''
+        self.source = source if source is not None else MicSource(channels, block_size, sample_rate)
         self.task = task
         self.beam_size = beam_size
+        """ model (and compute type) of the server registry decoding the requests (None: the server default) """
+        self.model = model
+        self.compute_type = compute_type
         self.channels = channels
         self.block_size = block_size
         self.sample_rate = sample_rate
         self.sleep_ms = sleep_ms
+        self.base_sleep_ms = sleep_ms
+        self.max_sleep_ms = max_sleep_ms or 8 * sleep_ms
+        """ 
+        adaptive ticks (sequential analysis): the hypothesis of the previous request is reused while the speech window is unchanged, 
+        the interval is shortened (down to min_sleep_ms) when speech has ended and widened when decoding takes longer than it 
+        """
+        self.adaptive = adaptive
+        self.min_sleep_ms = min(min_sleep_ms, sleep_ms)
+        self.interval_ms = sleep_ms
+        self.asr_ms = None
+        self.last_request = None
+        self.deadline_ms = deadline_ms
+        self.stream_words = stream_words
+        self.stream = uuid.uuid4().hex
         self.url_api = url_api
         self.language = language
         self.end_chars = end_chars
         self.skip_ini = skip_ini
         self.skip_end = skip_end
         self.timeout = 10
+        """ words of consecutive hypotheses agree when their texts match and their ends differ less than this (seconds) """
+        self.agreement_tolerance_sec = 0.3
+        self.agreement = agreement
+        self.agreement_hyps = deque(maxlen=max(1, agreement))
+        self.agreement_start = None
+        self.max_window = int(max_window_ms * sample_rate / 1000)
         self.silence_sec = silence_ms / 1000
         self.padding_sec = padding_ms / 1000
+        self.encoding = encoding
+        self.session = session
+        self.audio = RingBuffer(int(buffer_sec * sample_rate))
+        """ end of the audio dropped by capture buffer overflows (see clamp_start) """
+        self.dropped = 0
+        """ VAD run by the client, the server or both (vad='client': the server decodes the speech chunks of the client VAD) """
+        self.vad_mode = vad
+        self.stream_vad = StreamVAD(sample_rate) if stream_vad and vad != 'server' else None
+        self.energy_gate = EnergyGate(sample_rate) if energy_gate else None
+        self.session_id = None
+        self.session_sent = 0
+        self.committed = 0
+        """ url_api may contain a comma-separated list of servers (http://host:port/transcribe), the pool may be shared with other streams """
+        self.owns_servers = servers is None
+        self.servers = servers if servers is not None else ServerPool([url[:-len('/transcribe')] if url.endswith('/transcribe') else url for url in url_api.split(',')], routing, health_ms)
+        self.session_server = None
+        """ transcripts are re-decoded (final requests) one at a time, in the order they are created """
+        self.final = final
+        self.finals = ThreadPoolExecutor(max_workers=1, thread_name_prefix='final') if final else None
+        if session and inflight > 1:
+            """ concurrent uploads could reach the server session out of order (its audio would have gaps) """
+            raise ValueError('server sessions need sequential uploads: inflight must be at most 1 with session')
+        self.inflight = inflight
+        self.audio_start = 0
+        self.vad_result = None
+        """ error that stopped the pipelined VAD thread, raised by the analysis loop """
+        self.vad_error = None
+        """ keep-alive connections reused by all the requests (one per in-flight request), or shared with other streams """
+        self.http = http if http is not None else connection_pool(max(1, inflight))
         self.stats = defaultdict(list)
+        self.stats_sec = stats_sec
+        """ transcripts (and their audio) are archived in archive_dir as they are created """
+        self.archiver = Archiver(archive_dir, sample_rate, self.stats) if archive_dir is not None else None
 
     def __call__(self):
-        self.audio = np.empty(0, dtype=np.float32)
         self.transcripts = []
+        self.servers.start()
+        if self.stats_sec > 0:
+            threading.Thread(target=self.dump_stats, name='stats', daemon=True).start()
 
         def callback(indata, frames, time, status):
             """
-            This function is employed by sd.InputStream to store the wave continuously read from the mic into self.audio.
-            The function is called whenever new block_size floats are available read from the mic.
+            This function is employed by the audio source (sd.InputStream) to store the wave continuously read from the mic into self.audio.
+            The function is called whenever new block_size floats are available read from the mic (runs in the audio thread, 
+            the ring buffer append only copies the new block).
             Params:
-            indata: numpy.ndarray (block_size, 1) dtype=float32 containing audio captured from microphone. 
+            indata: numpy.ndarray (block_size, channels) dtype=float32 containing audio captured from microphone (the first channel is used). 
             frames: indicate the number of floats (same as block_size)
             time: time indication
             status: exit indication
             """
             if status:
-                logging.error('callback error: '.format(status))
-            self.audio = np.concatenate((self.audio, indata.squeeze()), dtype=np.float32)
-
-        with sd.InputStream(
-            device=self.mic, 
-            channels=self.channels, 
-            callback=callback, 
-            blocksize=self.block_size, 
-            samplerate=self.sample_rate):
-        
+                logging.error('callback error: {}'.format(status))
+            self.audio.append(indata[:, 0])
+
+        with self.source.open(callback):
+
+            if self.inflight > 0:
+                return self.pipeline()
+
             audio_start = 0
-            """ infinite loop (stopped using [Ctrl+c]) """
-            tic = time.time()
-            while True:
-
-                time_spent_ms = int((time.time()-tic)*1000)
-                if time_spent_ms < self.sleep_ms:
-                    time_sleep_ms = self.sleep_ms-time_spent_ms
-                    self.stats['time_SLEEP'].append(time_sleep_ms/1000)
-                    sd.sleep(time_sleep_ms)
-                else:
-                    time_delay_ms = time_spent_ms-self.sleep_ms
-                    self.stats['time_DELAY'].append(time_delay_ms/1000)
-
-                tic = time.time()
+            """ infinite loop (stopped using [Ctrl+c]) or until the source is replayed """
+            tic = self.source.time()
+            while self.source.active():
+                tic = self.wait_tick(tic, self.interval_ms)
+                tic_TICK = time.time()
                 audio_start = self.analyse_audio(audio_start, len(self.audio))
+                self.stats['time_TICK'].append(time.time() - tic_TICK)
+                self.commit(audio_start)
+
+    def wait_tick(self, tic, interval_ms=None):
+        """ sleeps until interval_ms (default: sleep_ms, source time) after tic, returns the start of the new tick """
+        interval_ms = interval_ms or self.sleep_ms
+        time_spent_ms = int((self.source.time()-tic)*1000)
+        if time_spent_ms < interval_ms:
+            time_sleep_ms = interval_ms-time_spent_ms
+            self.stats['time_SLEEP'].append(time_sleep_ms/1000)
+            self.source.sleep(time_sleep_ms)
+        else:
+            time_delay_ms = time_spent_ms-interval_ms
+            self.stats['time_DELAY'].append(time_delay_ms/1000)
+        return self.source.time()
+
+    def pipeline(self):
+        """
+        Pipelined analysis loop: the VAD runs continuously over the new audio in its own thread and up to self.inflight ASR
+        requests are pending at once. Every sleep_ms a request is sent for the latest speech window found by the VAD, results 
+        are handled in the order requests were sent (results of requests sent before audio_start moved are discarded)
+        """
+        stop = threading.Event()
+        threading.Thread(target=self.vad_worker, args=(stop,), name='vad', daemon=True).start()
+        executor = ThreadPoolExecutor(max_workers=self.inflight, thread_name_prefix='asr-request')
+        pending = deque()
+        try:
+            tic = self.source.time()
+            while self.source.active():
+                tic = self.wait_tick(tic)
+                if self.vad_error is not None:
+                    raise self.vad_error
+                self.reconcile(pending, wait=len(pending) >= self.inflight)
+                self.stats['n_INFLIGHT'].append(len(pending))
+
+                result = self.vad_result
+                if result is None or result['audio_start'] != self.audio_start:
+                    """ the VAD has not analysed the audio from the current audio_start yet """
+                    continue
+                audio_start, vad, speech_start, speech_end = result['speech']
+                if vad is None:
+                    self.advance_start(audio_start)
+                    continue
+                if len(pending) and pending[-1]['window'] == [speech_start, speech_end]:
+                    """ the window is already being transcribed """
+                    continue
+                self.advance_start(audio_start)
+                self.stats['time_speech'].append((speech_end - speech_start)/self.sample_rate)
+                pending.append({
+                    'audio_start': audio_start, 
+                    'vad': vad, 
+                    'window': [speech_start, speech_end], 
+                    'tic': time.time(),
+                    'future': executor.submit(self.timed_request, speech_start, speech_end, vad)})
+            """ the source is replayed: the pending results are handled """
+            while len(pending):
+                self.reconcile(pending, wait=True)
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
 
-    def analyse_audio(self, audio_start, audio_end):
+    def vad_worker(self, stop):
+        """ runs the VAD over self.audio[self.audio_start:] whenever a new block is captured, keeps the latest result in self.vad_result """
+        audio_end = 0
+        while not stop.is_set():
+            audio_start = self.audio_start
+            if len(self.audio) - audio_end < self.block_size and self.vad_result is not None and self.vad_result['audio_start'] == audio_start:
+                stop.wait(self.block_size / self.sample_rate / 2)
+                continue
+            audio_end = len(self.audio)
+            try:
+                """ speech[0] is the new audio_start: the overflow dropped is committed by pipeline() """
+                speech = self.detect_speech(self.clamp_start(audio_start), audio_end)
+            except Exception as e:
+                logging.exception('VAD thread stopped: {}'.format(e))
+                self.vad_error = e
+                return
+            self.vad_result = {'audio_start': audio_start, 'audio_end': audio_end, 'speech': speech}
+
+    def timed_request(self, speech_start, speech_end, vad):
+        """ asr_request run by the in-flight workers """
+        tic_request = time.time()
+        hyp = self.asr_request(speech_start, speech_end, vad)
+        self.stats['time_ASR'].append(time.time() - tic_request)
+        return hyp
+
+    def reconcile(self, pending, wait=False):
+        """
+        Handles the results of the requests completed, in the order they were sent. When wait is True the oldest request is
+        waited for (the in-flight queue is full)
+        """
+        while len(pending) and (wait or pending[0]['future'].done()):
+            request = pending.popleft()
+            wait = False
+            tic_WAIT = time.time()
+            hyp = request['future'].result()
+            self.stats['time_WAIT'].append(time.time() - tic_WAIT)
+            if request['audio_start'] != self.audio_start:
+                """ a previous result created a transcript: the window of this request is stale """
+                self.stats['n_STALE'].append(1)
+                continue
+            """ time from sending the request to handling its result (time_TICK is the duration of a sequential tick) """
+            self.stats['time_HANDLED'].append(time.time() - request['tic'])
+            self.advance_start(self.handle_hyp(hyp, request['vad'], self.audio_start))
+
+    def advance_start(self, audio_start):
+        if audio_start != self.audio_start:
+            self.audio_start = audio_start
+            self.commit(audio_start)
+
+    def commit(self, audio_start):
+        """ audio before audio_start will not be analysed anymore: it is released from the capture buffer """
+        self.committed = audio_start
+        self.audio.release(audio_start)
+
+    def analyse_audio(self, audio_start, audio_end, speech_chunks=None, gated=False):
         """ 
         Analyses self.audio[self.audio_start:audio_end] looking for speech transcripts
         Params:
         audio_start : analysis initial point of self.audio
         audio_end : analysis ending point of self.audio
+        speech_chunks : (optional) speech chunks of the window already found by a VAD shared with other streams
+        gated : the energy gate was already run over the window by the caller
         Returns:
         The new position of audio_start
         """
+        audio_start = self.clamp_start(audio_start)
         logging.info('analyse audio[{}, {}) => {:.2f} sec'.format(audio_start, audio_end, (audio_end-audio_start)/self.sample_rate))
 
+        audio_start, vad, speech_start, speech_end = self.detect_speech(audio_start, audio_end, speech_chunks, gated)
+        if vad is None:
+            self.interval_ms = self.tick_interval(None)
+            return audio_start
+
+        """ ASR request over self.audio[audio_start, audio_end] (unless no new speech came since the previous one) """
+        hyp = self.previous_hyp(vad, speech_start, speech_end) if self.adaptive else None
+        time_asr = None
+        if hyp is None:
+            tic_request = time.time()
+            hyp = self.asr_request(speech_start, speech_end, vad)
+            time_asr = time.time() - tic_request
+            self.stats['time_ASR'].append(time_asr)
+            self.stats['time_speech'].append((speech_end - speech_start)/self.sample_rate)
+            self.last_request = {'window': [speech_start, speech_end], 'speech_chunks': [dict(c) for c in vad.speech_chunks], 'hyp': copy.deepcopy(hyp)}
+        self.interval_ms = self.tick_interval(vad, time_asr)
+
+        return self.handle_hyp(hyp, vad, audio_start)
+
+    def clamp_start(self, audio_start):
+        """
+        The capture buffer keeps buffer_sec of audio: when audio_start lags further behind (no server answers, noise decoded 
+        to empty hypotheses...) the audio about to be overwritten is dropped. max_sleep_ms of slack are left so that the 
+        audio is not overwritten while the window is read
+        Returns:
+        The new position of audio_start
+        """
+        slack = min(int(self.max_sleep_ms * self.sample_rate / 1000), self.audio.capacity // 2)
+        new_start = max(self.audio.oldest(), len(self.audio) - self.audio.capacity + slack)
+        if audio_start >= new_start:
+            return audio_start
+        """ the pipelined VAD may clamp the same audio_start again before it is advanced: the audio dropped is counted once """
+        dropped = max(audio_start, self.dropped)
+        if new_start > dropped:
+            logging.error('capture buffer overflow: audio [{}, {}) dropped ({:.2f} sec)'.format(dropped, new_start, (new_start - dropped)/self.sample_rate))
+            self.stats['rejected_OVERFLOW'].append((new_start - dropped)/self.sample_rate)
+            self.dropped = new_start
+        return new_start
+
+    def previous_hyp(self, vad, speech_start, speech_end):
+        """ returns (a copy of) the hypothesis of the previous request when its window and speech chunks are those of vad, None otherwise """
+        last = self.last_request
+        if last is None or last['hyp'] is None or last['hyp'].hyp is None:
+            return None
+        if last['window'] != [speech_start, speech_end] or last['speech_chunks'] != vad.speech_chunks:
+            return None
+        logging.info('window [{}, {}) unchanged: request skipped'.format(speech_start, speech_end))
+        self.stats['n_SKIPPED'].append(1)
+        hyp = copy.deepcopy(last['hyp'])
+        hyp.reused = True
+        return hyp
+
+    def tick_interval(self, vad, time_asr=None):
+        """
+        Returns the interval (ms) before the next analysis: sleep_ms, or with adaptive ticks
+        - sleep_ms widened (up to max_sleep_ms) while decoding (moving average of time_ASR) takes longer than it
+        - once the speech of vad has ended, the time left until the silence reaches silence_ms (so that the [endsilence] 
+          transcript is created as soon as possible), at least min_sleep_ms
+        """
+        if not self.adaptive:
+            return self.sleep_ms
+        if time_asr is not None:
+            """ decoding time in source time (replayed files run faster than real time) """
+            asr_ms = 1000 * time_asr * self.source.speed
+            self.asr_ms = asr_ms if self.asr_ms is None else 0.8 * self.asr_ms + 0.2 * asr_ms
+            if self.asr_ms > self.sleep_ms:
+                self.sleep_ms = self.floor_sleep_ms()
+                logging.info('decoding slower than the interval ({:.0f} ms): interval set to {} ms'.format(self.asr_ms, self.sleep_ms))
+        interval_ms = self.sleep_ms
+        if vad is not None and len(vad):
+            silence_ms = 1000 * (vad.end - vad.speech_chunks[-1]['end']) / self.sample_rate
+            if 0 < silence_ms < 1000 * self.silence_sec:
+                interval_ms = max(self.min_sleep_ms, min(interval_ms, int(1000 * self.silence_sec - silence_ms)))
+        self.stats['time_INTERVAL'].append(interval_ms / 1000)
+        return interval_ms
+
+    def floor_sleep_ms(self):
+        """ the interval does not go below sleep_ms, nor (adaptive ticks) below the decoding time """
+        if not self.adaptive or self.asr_ms is None:
+            return self.base_sleep_ms
+        return min(self.max_sleep_ms, max(self.base_sleep_ms, int(1.25 * self.asr_ms)))
+
+    def gate(self, audio_start, audio_end):
+        """
+        Runs the energy gate over self.audio[audio_start:audio_end]
+        Returns:
+        (audio_start, speech): audio_start moved forward past the audio rejected by the gate, speech is False when the 
+        whole window is rejected
+        """
+        tic_GATE = time.time()
+        gate_start = self.energy_gate(self.audio, audio_start, audio_end)
+        self.stats['time_GATE'].append(time.time() - tic_GATE)
+        if gate_start is None:
+            new_start = max(audio_start, self.energy_gate.offset - int(self.padding_sec*self.sample_rate))
+            self.stats['rejected_GATE'].append((new_start - audio_start)/self.sample_rate)
+            logging.info('gate: no speech, audio_start={}'.format(new_start))
+            return new_start, False
+        if gate_start - int(self.padding_sec*self.sample_rate) > audio_start:
+            new_start = gate_start - int(self.padding_sec*self.sample_rate)
+            self.stats['rejected_GATE'].append((new_start - audio_start)/self.sample_rate)
+            return new_start, True
+        self.stats['rejected_GATE'].append(0.0)
+        return audio_start, True
+
+    def detect_speech(self, audio_start, audio_end, speech_chunks=None, gated=False):
+        """
+        Runs the energy gate (if any, unless gated: already run by the caller) and the VAD over 
+        self.audio[audio_start:audio_end] (the VAD is skipped when the speech_chunks of the window are given)
+        Returns:
+        (audio_start, vad, speech_start, speech_end): vad is None when no speech is found (audio_start is then moved forward), 
+        otherwise [speech_start, speech_end) is the audio to transcribe
+        """
+        """ skip the neural VAD over the leading audio (or the whole window) where block energies do not cross the gate threshold """
+        if self.energy_gate is not None and not gated:
+            audio_start, speech = self.gate(audio_start, audio_end)
+            if not speech:
+                return audio_start, None, None, None
+
+        """ the server runs the VAD: the whole window is sent, speech chunks come with the hypothesis (see handle_hyp) """
+        if self.vad_mode == 'server':
+            vad = VAD(None, audio_start, audio_end, self.sample_rate, self.silence_sec, self.padding_sec, speech_chunks=[{'start': audio_start, 'end': audio_end}])
+            return audio_start, vad, audio_start, self.cap_window(audio_start, audio_end)
+
         """ compute speech chunks using VAD """
-        tic_VAD = time.time()
-        vad = VAD(self.audio, audio_start, audio_end, self.sample_rate, self.silence_sec, self.padding_sec)
-        self.stats['time_VAD'].append(time.time() - tic_VAD)
+        if speech_chunks is not None:
+            speech_chunks = [{'start': max(audio_start, c['start']), 'end': c['end']} for c in speech_chunks if c['end'] > audio_start]
+            vad = VAD(self.audio, audio_start, audio_end, self.sample_rate, self.silence_sec, self.padding_sec, speech_chunks=speech_chunks)
+        else:
+            tic_VAD = time.time()
+            vad = VAD(self.audio, audio_start, audio_end, self.sample_rate, self.silence_sec, self.padding_sec, self.stream_vad)
+            self.stats['time_VAD'].append(time.time() - tic_VAD)
 
         if len(vad) == 0: 
-            return vad.pad_to_end(audio_start,audio_end)
+            self.stats['rejected_VAD'].append((audio_end - audio_start)/self.sample_rate)
+            return vad.pad_to_end(audio_start,audio_end), None, None, None
 
         """ find_speech using VAD results to restrict the ASR request """
         speech_start, speech_end = vad.adjust_speech()
+        self.stats['rejected_VAD'].append((audio_end - audio_start - speech_end + speech_start)/self.sample_rate)
+        return audio_start, vad, speech_start, self.cap_window(speech_start, speech_end)
 
-        """ ASR request over self.audio[audio_start, audio_end] """
-        tic_request = time.time()
-        hyp = self.asr_request(speech_start, speech_end)
-        self.stats['time_ASR'].append(time.time() - tic_request)
-        self.stats['time_speech'].append((speech_end - speech_start)/self.sample_rate)
+    def cap_window(self, speech_start, speech_end):
+        """ the audio sent in a request is limited to max_window samples (the rest is transcribed by the next requests) """
+        if self.max_window and speech_end - speech_start > self.max_window:
+            return speech_start + self.max_window
+        return speech_end
 
-        if len(hyp) == 0:
+    def handle_hyp(self, hyp, vad, audio_start):
+        """
+        Saves hyp (or its prefix) as transcript when the audio is ended by a silence or hyp contains an end char
+        Returns:
+        The new position of audio_start
+        """
+        """ VAD run by the server: its speech chunks replace the whole window assumed speech by detect_speech """
+        if self.vad_mode == 'server' and hyp is not None and hyp.speech_chunks is not None:
+            vad = VAD(None, vad.start, vad.end, self.sample_rate, self.silence_sec, self.padding_sec, 
+                speech_chunks=[{'start': hyp.start + c['start'], 'end': hyp.start + c['end']} for c in hyp.speech_chunks])
+            if len(vad) == 0:
+                return vad.pad_to_end(audio_start, vad.end)
+
+        if hyp is None:
             return audio_start
+        """ the window was capped to max_window samples by cap_window """
+        capped = self.max_window and hyp.end - hyp.start >= self.max_window
+        if len(hyp) == 0:
+            return self.drop_window(hyp) if capped else audio_start
 
-        """ save hyp as transcript if the audio analysed is ended by a silence """
-        if vad.ending_silence():
+        """ save hyp as transcript if the audio analysed is ended by a silence (and the hyp covers all of it) """
+        if hyp.complete and vad.ending_silence():
             self.add_transcript(hyp, 'endsilence')
             return hyp.end
 
         """ save intermediate_hyp as transcript if contains a punctuation mark """
-        hyp_prefix = self.has_endchar(hyp, speech_start)
+        hyp_prefix = self.has_endchar(hyp, hyp.start)
         if hyp_prefix is not None:
             self.add_transcript(hyp_prefix, 'endchars')
             return hyp_prefix.end
 
+        """ save the prefix of hyp that stayed the same over the last requests """
+        hyp_prefix = self.agreed_prefix(hyp, audio_start)
+        if hyp_prefix is not None:
+            self.add_transcript(hyp_prefix, 'agreement')
+            return hyp_prefix.end
+
+        """ the window reached its maximum length: save hyp but its last word """
+        if capped and len(hyp) > 1:
+            hyp_prefix = copy.deepcopy(hyp)
+            hyp_prefix.remove_after_token_n(len(hyp) - 2, self.sample_rate)
+            self.add_transcript(hyp_prefix, 'maxwindow')
+            return hyp_prefix.end
+        if capped:
+            return self.drop_window(hyp)
+
         return audio_start
 
+    def drop_window(self, hyp):
+        """ 
+        A capped window with no prefix to save (noise, music...) would be decoded again at every tick: it is dropped 
+        (audio_start moves to its end) 
+        """
+        logging.warning('window [{}, {}) dropped: max window reached without transcript ({})'.format(hyp.start, hyp.end, str(hyp)))
+        self.stats['rejected_MAXWINDOW'].append((hyp.end - hyp.start) / self.sample_rate)
+        return hyp.end
+
+    def agreed_prefix(self, hyp, audio_start):
+        """
+        Local agreement: compares hyp with the hypotheses of the previous agreement-1 requests (since audio_start) and
+        returns the prefix of hyp whose words (text and end time) are the same in all of them, the last word of hyp 
+        is never part of the prefix. Returns None when no prefix is stable. A reused hypothesis (skipped request) is not a new
+        decoding: it is not compared
+        """
+        if not self.agreement or not hyp.complete or hyp.reused:
+            return None
+        if self.agreement_start != audio_start:
+            self.agreement_start = audio_start
+            self.agreement_hyps.clear()
+        words = [(hyp.start + int(w[1] * self.sample_rate), w[2].strip(' ,.!?;:').lower()) for w in hyp.hyp]
+        self.agreement_hyps.append(words)
+        if len(self.agreement_hyps) < self.agreement:
+            return None
+        tolerance = self.agreement_tolerance_sec * self.sample_rate
+        n = 0
+        while n < len(words) - 1 and all(n < len(h) and h[n][1] == words[n][1] and abs(h[n][0] - words[n][0]) <= tolerance for h in self.agreement_hyps):
+            n += 1
+        if n == 0:
+            return None
+        logging.info('agreement: {} words stable over {} requests'.format(n, self.agreement))
+        hyp_prefix = copy.deepcopy(hyp)
+        hyp_prefix.remove_after_token_n(n - 1, self.sample_rate)
+        return hyp_prefix
+
     def add_transcript(self, hyp, end_by):
-        self.transcripts.append({'start': hyp.start, 'end': hyp.end, 'str': str(hyp), 'language': hyp.language})
-        print("***: {} ({}) [{}, {}) time=[{:.2f}, {:.2f}] len={:.2f} sec [{}]".format(str(hyp), hyp.language, hyp.start, hyp.end, hyp.start/self.sample_rate, hyp.end/self.sample_rate, (hyp.end-hyp.start)/self.sample_rate, end_by))
+        self.transcripts.append({'start': hyp.start, 'end': hyp.end, 'str': str(hyp), 'language': hyp.language, 'end_by': end_by})
+        """ stream time (seconds) elapsed between the end of the transcript audio and its creation """
+        self.stats['time_COMMIT_LAG'].append((len(self.audio) - hyp.end) / self.sample_rate)
+        print(self.prefix + "***: {} ({}) [{}, {}) time=[{:.2f}, {:.2f}] len={:.2f} sec [{}]".format(str(hyp), hyp.language, hyp.start, hyp.end, hyp.start/self.sample_rate, hyp.end/self.sample_rate, (hyp.end-hyp.start)/self.sample_rate, end_by))
+        if self.finals is None and self.archiver is None:
+            return
+        try:
+            audio = self.audio[hyp.start:hyp.end]
+        except IndexError as e:
+            logging.warning('audio of the transcript not available: {}'.format(e))
+            audio = None
+        transcript = self.transcripts[-1]
+        if self.finals is not None and audio is not None:
+            history = self.transcripts[-2]['str'] if len(self.transcripts) > 1 else None
+            future = self.finals.submit(self.final_request, transcript, audio, history)
+            if self.archiver is not None:
+                """ the transcript is archived once its final text is known """
+                future.add_done_callback(lambda f: self.archiver.submit(transcript, audio))
+        elif self.archiver is not None:
+            self.archiver.submit(transcript, audio)
+
+    def final_request(self, transcript, audio, history):
+        """
+        Re-decodes the audio of transcript with the final model of the server (request option final), the text of 
+        the transcript is replaced by the result. Runs in the finals thread
+        """
+        tic = time.time()
+        options = {"language": self.language, "history": history, "beam_size": self.beam_size, "task": self.task, "final": True}
+        response = self.post('/transcribe', audio, options, stream=False)
+        if response is None:
+            return
+        try:
+            hyp = Hyp(response.json(), transcript['start'], transcript['end'], self.prefix)
+        except requests.exceptions.JSONDecodeError as e:
+            logging.error("Response body did not contain valid json: {}".format(e))
+            return
+        self.stats['time_FINAL'].append(time.time() - tic)
+        if hyp.hyp is None:
+            return
+        text = str(hyp)
+        self.stats['n_FINAL_CHANGED'].append(int(text != transcript['str']))
+        if text != transcript['str']:
+            print(self.prefix + "fin: {} ({}) [{}, {}) was: {}".format(text, hyp.language, transcript['start'], transcript['end'], transcript['str']))
+        transcript.update({'str': text, 'language': hyp.language, 'final': True})
+
+    def wait_finals(self):
+        """ waits for the pending final requests """
+        if self.finals is not None:
+            self.finals.shutdown(wait=True)
 
     def has_endchar(self, hyp, speech_start):
         """
@@ -153,70 +612,240 @@ class StreamMic():
             return new_hyp
         return None
 
-    def asr_request(self, start, end):
+    def asr_request(self, start, end, vad=None):
         """ 
         Performs a request to the asr server using the wave form contained in self.audio[start:end] data
         Params:
         start: initial point of speech in self.audio to transcribe
         end: ending point of speech in self.audio to transcribe 
+        vad: (optional) VAD of the window, its speech chunks are sent when the server decodes the client speech chunks
         Returns:
-        hyp: class containing the transcript hypothesis
+        hyp: class containing the transcript hypothesis (None when no server could serve the request)
         """
+        tic = time.time()
         history = self.transcripts[-1]['str'] if len(self.transcripts) else None
-        try:
-            response = requests.post(
-                self.url_api, 
-                json={
-                    "audio": self.audio[start:end].tolist(), 
-                    "language": self.language, 
-                    "history": history, 
-                    "beam_size": self.beam_size, 
-                    "task": self.task}, 
-                headers={"Content-Type": "application/json"}, 
-                timeout=self.timeout)
-        except requests.exceptions.Timeout: 
-            logging.error("POST Request Error (Timeout):", e)
-            raise SystemExit(e)
-        except requests.exceptions.ConnectionError as e:
-            logging.error("POST Request Error (ConnectionError):", e)
-            raise SystemExit(e)
-        except requests.exceptions.TooManyRedirects: 
-            logging.error("POST Request Error (TooManyRedirects):", e)
-            raise SystemExit(e)
-        except requests.exceptions.HTTPError as e:
-            logging.error("POST Request Error (HTTPError):", e)
-            raise SystemExit(e)
-        except requests.exceptions.RequestException as e: 
-            logging.error("POST Request Error (RequestException):", e)
-            raise SystemExit(e)
+        options = {
+            "language": self.language, 
+            "history": history, 
+            "beam_size": self.beam_size, 
+            "task": self.task,
+            "model": self.model,
+            "compute_type": self.compute_type,
+            "stream": self.stream,
+            "window": [start, end],
+            "deadline_ms": self.deadline_ms or None}
+        if self.vad_mode == 'client' and vad is not None:
+            options['speech_chunks'] = self.request_chunks(vad, start, end)
+        if self.session:
+            response = self.session_request(start, end, options)
+        else:
+            response = self.post('/transcribe', self.audio[start:end], options)
+        if response is None:
+            return None
+        self.backpressure(response)
+        if 400 <= response.status_code < 500 and response.status_code != 409:
+            return self.rejected(response)
+        if response.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+            return self.read_stream(response, start, end, tic)
 
         try:
             response_json = response.json()
+        except requests.exceptions.JSONDecodeError as e:
+            logging.error("Response body did not contain valid json: {}".format(e))
+            return None
+
+        """ in session mode the server may clip the window to the audio it keeps """
+        start, end = response_json.get('window', (start, end))
+        return Hyp(response_json, start, end, self.prefix)
+
+    def rejected(self, response):
+        """
+        Handles a request rejected by the server (4xx status but 409 coalesced): the error is logged and counted in n_FAILED.
+        A model (or compute type) not offered by the server will never be served: ValueError is raised
+        """
+        try:
+            content = response.json()
         except requests.exceptions.JSONDecodeError:
-            logging.error("Response body did not contain valid json:", e)
-            raise SystemExit(e)
+            content = {}
+        self.stats['n_FAILED'].append(1)
+        logging.error('request rejected by {} (HTTP {}): {}'.format(response.url, response.status_code, content.get('error')))
+        if content.get('status') == 'unavailable':
+            raise ValueError('{} (model={} compute_type={})'.format(content.get('error'), self.model, self.compute_type))
+        return None
 
-        return Hyp(response_json, start, end)
+    def request_chunks(self, vad, start, end):
+        """ speech chunks of vad within [start, end) relative to start """
+        return [{'start': max(c['start'], start) - start, 'end': min(c['end'], end) - start} for c in vad.speech_chunks if c['end'] > start and c['start'] < end]
 
-    def save_transcripts(self, odir):
-        if os.path.exists(odir):
-            os.remove(odir+'/*.{mp3,txt}')
+    def read_stream(self, response, start, end, tic):
+        """
+        Consumes a streamed response (one json event per line) word by word. Reading stops as soon as the hypothesis contains
+        an end char (the server then stops decoding), the hypothesis returned is then not complete
+        """
+        hyp = Hyp({}, start, end, self.prefix)
+        hyp.complete = False
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if 'window' in event:
+                    hyp.start, hyp.end = event['window']
+                if event['type'] == 'word' and hyp.hyp is not None and len(hyp.hyp) == 0:
+                    self.stats['time_FIRSTWORD'].append(time.time() - tic)
+                if hyp.update(event):
+                    break
+                if event['type'] == 'word' and hyp.has_endchars(self.end_chars, self.skip_ini, self.skip_end) is not None:
+                    logging.info('endchars found while streaming, {} words read'.format(len(hyp)))
+                    break
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error("Streamed response error: {}".format(e))
+        finally:
+            response.close()
+        return hyp
+
+    def backpressure(self, response):
+        """
+        Widens the interval between requests when the server is overloaded (request shed or estimated queue wait longer 
+        than the interval), the interval goes back progressively to its initial value otherwise
+        """
+        queue_wait_ms = 1000 * float(response.headers.get('X-Queue-Wait', 0))
+        if response.status_code == 503 or queue_wait_ms > self.sleep_ms:
+            self.sleep_ms = min(self.max_sleep_ms, 2 * self.sleep_ms)
+            logging.warning('server overloaded (status={} queue_wait={:.0f} ms): interval set to {} ms'.format(response.status_code, queue_wait_ms, self.sleep_ms))
+        elif self.sleep_ms > self.floor_sleep_ms():
+            self.sleep_ms = max(self.floor_sleep_ms(), int(0.8 * self.sleep_ms))
+        if response.status_code == 409:
+            self.stats['n_COALESCED'].append(1)
+        elif response.status_code == 503:
+            self.stats['n_SHED'].append(1)
+
+    def post(self, path, audio, options, server=None, stream=None):
+        """
+        Posts audio and options to path of a server of the pool, the audio is sent as indicated by self.encoding (json list 
+        of floats or binary). A request failing (connection error, timeout or server error) is retried on another server 
+        as long as the time budget of the request (deadline_ms, timeout otherwise) is not exhausted
+        Params:
+        server: (optional) the request is only sent to this server
+        stream: (optional) ask for a streamed response (default: self.stream_words)
+        Returns:
+        response: requests.Response (streamed, one json event per line, when self.stream_words) or None when no server answered
+        """
+        stream = self.stream_words if stream is None else stream
+        accept = "application/x-ndjson" if stream else "application/json"
+        tic_ENCODE = time.time()
+        if self.encoding == 'json':
+            kwargs = {'json': dict(options, audio=audio.tolist()), 'headers': {"Content-Type": "application/json", "Accept": accept}}
         else:
-            os.mkdir(odir)
-        with open(odir + '/transcripts.txt', 'w') as fdesc:
-            for i,t in enumerate(self.transcripts):
-                start = t['start']
-                end = t['end']
-                tstart = "{:.2f}".format(start / self.sample_rate)
-                tend = "{:.2f}".format(end / self.sample_rate)
-                fname = odir + '/audio.' + str(i) + '_' + tstart + '_' + tend + '.mp3'
-                save(self.audio[start:end], fname)
-                fdesc.write("{}\t{}\t{}\t{}\n".format(i, tstart, tend, t['str']))
-
-    def print_stats(self):
-        print("Time stats (seconds)", file=sys.stderr)
-        for name, l in self.stats.items():
-            print("{}\t{:.2f}\t{}\t{:.2f}".format(name, sum(l), len(l), sum(l)/len(l)), file=sys.stderr)
+            kwargs = {
+                'data': encode(audio, self.encoding, self.sample_rate), 
+                'headers': {"Content-Type": "application/octet-stream", "X-Audio-Encoding": self.encoding, "X-Options": encode_options(options), "Accept": accept}}
+        self.stats['time_ENCODE'].append(time.time() - tic_ENCODE)
+        tic = time.time()
+        budget = (self.deadline_ms or 1000 * self.timeout) / 1000
+        tried = [s for s in self.servers.servers if s is not server] if server is not None else []
+        while True:
+            remaining = budget - (time.time() - tic)
+            if remaining <= 0:
+                break
+            target = self.servers.pick(exclude=tried)
+            if target is None:
+                break
+            tried.append(target)
+            tic_request = time.time()
+            try:
+                response = self.http.post(target.url + path, stream=stream, timeout=min(self.timeout, remaining), **kwargs)
+            except requests.exceptions.RequestException as e:
+                logging.error("POST Request Error ({}) {}: {}".format(type(e).__name__, target.url, e))
+                self.servers.done(target, error=e)
+                continue
+            if response.status_code >= 500 and response.status_code != 503:
+                logging.error("POST Request Error (HTTP {}) {}".format(response.status_code, target.url))
+                self.servers.done(target, error='HTTP {}'.format(response.status_code))
+                response.close()
+                continue
+            self.servers.done(target, latency=time.time() - tic_request)
+            self.stats['bytes_SENT'].append(len(response.request.body or b''))
+            return response
+        self.stats['n_FAILED'].append(1)
+        logging.error('request to {} failed on {} servers'.format(path, len(tried)))
+        return None
+
+    def session_request(self, start, end, options, reopen=True):
+        """
+        Transcribes self.audio[start:end] within the server session, only the samples not yet sent are uploaded
+        (the server keeps the session audio from the last committed position). The session is reopened (on another server
+        if needed) when its server closed it or does not answer
+        """
+        if self.session_id is None and not self.open_session():
+            return None
+        offset = max(self.session_sent, self.committed)
+        response = self.post(
+            '/session/{}/transcribe'.format(self.session_id), 
+            self.audio[offset:end], 
+            dict(options, offset=offset, start=start, end=end, commit=self.committed),
+            server=self.session_server)
+        if response is None or response.status_code == 404:
+            logging.warning('session {} lost on {}, reopening'.format(self.session_id, self.session_server.url))
+            self.session_id = None
+            self.session_sent = 0
+            return self.session_request(start, end, options, reopen=False) if reopen else None
+        self.session_sent = max(self.session_sent, end)
+        return response
+
+    def open_session(self):
+        """ opens a session on a server of the pool, returns False when no server could open it """
+        tried = []
+        while True:
+            server = self.servers.pick(exclude=tried)
+            if server is None:
+                return False
+            tried.append(server)
+            tic = time.time()
+            try:
+                response = self.http.post(server.url + '/session', json={"language": self.language, "beam_size": self.beam_size, "task": self.task, "model": self.model, "compute_type": self.compute_type}, timeout=self.timeout)
+                response.raise_for_status()
+                self.session_id = response.json()['session']
+            except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+                logging.error("Session Error {}: {}".format(server.url, e))
+                self.servers.done(server, error=e)
+                continue
+            self.servers.done(server, latency=time.time() - tic)
+            self.session_server = server
+            logging.info('session {} opened on {}'.format(self.session_id, server.url))
+            return True
+
+    def close(self):
+        """ closes the server session (if any) and waits for the transcripts to be archived """
+        self.wait_finals()
+        if self.archiver is not None:
+            self.archiver.close()
+        """ the health checks of a shared pool are stopped by the stream that created it """
+        if self.owns_servers:
+            self.servers.stop()
+        if self.session_id is None:
+            return
+        try:
+            self.http.delete(self.session_server.url + '/session/{}'.format(self.session_id), timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Session Error: {}".format(e))
+        self.session_id = None
+
+    def print_stats(self, servers=True):
+        """ servers: the stats of the server pool are printed too (once for the streams sharing it) """
+        print(self.prefix + "Stats (name sum count mean p50 p95 p99): time_* in seconds, bytes_* in bytes", file=sys.stderr)
+        if self.audio.overflows:
+            print("capture buffer overflows: {}".format(self.audio.overflows), file=sys.stderr)
+        print_stat_lines(self.stats, sys.stderr)
+        if servers:
+            self.servers.print_stats(sys.stderr)
+
+    def dump_stats(self):
+        """ prints the stats every stats_sec seconds """
+        while True:
+            time.sleep(self.stats_sec)
+            print("[{}]".format(time.strftime('%Y-%m-%d_%H:%M:%S')), file=sys.stderr)
+            self.print_stats()
 
 
     
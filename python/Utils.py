@@ -32,6 +32,17 @@ def save(data, file_name, sample_rate=16000):
     sf.write(file_name, data, sample_rate)
     logging.info('SAVED')
 
-def is_silence(data, silence_threshold):
-    """ data is a numpy.ndarray (block_size, 1) dtype=float32 containing audio wave """
-    return np.sqrt(np.mean(np.square(data))) < silence_threshold
+def rms(data, axis=None):
+    """ root mean square of data (along axis) """
+    return np.sqrt(np.mean(np.square(data), axis=axis))
+
+def zero_crossing_rate(data, axis=-1):
+    """ rate of sign changes between consecutive samples of data (along axis) """
+    return np.mean(np.signbit(data[..., 1:]) != np.signbit(data[..., :-1]), axis=axis)
+
+def is_silence(data, silence_threshold, axis=None):
+    """ 
+    data is a numpy.ndarray (block_size, 1) dtype=float32 containing audio wave 
+    or a numpy.ndarray (n_blocks, block_size) with axis=1 to get one decision per block
+    """
+    return rms(data, axis=axis) < silence_threshold
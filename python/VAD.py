@@ -1,6 +1,8 @@
 import logging
+import numpy as np
 from typing import NamedTuple
-from faster_whisper.vad import get_speech_timestamps
+from python.Utils import rms, zero_crossing_rate, is_silence
+from faster_whisper.vad import get_speech_timestamps, get_vad_model
 
 
 class VadOptions(NamedTuple):
@@ -29,19 +31,204 @@ class VadOptions(NamedTuple):
     window_size_samples: int = 1024 #1024
     speech_pad_ms: int = 100 #400
 
+class EnergyGate():
+
+    def __init__(self, sample_rate=16000, block_ms=32, factor=3.0, min_threshold=0.002, zcr_threshold=0.25, adaptation=0.1):
+        """
+        Cheap speech pre-detector run before the neural VAD. New audio is split in blocks of block_ms, a block may contain speech 
+        when its energy is not silence wrt an adaptive threshold (factor times the noise floor, at least min_threshold) 
+        or when half that energy comes with a high zero-crossing rate (fricatives)
+        Params:
+        sample_rate: the sample rate of the audio wave
+        block_ms: block size (ms)
+        factor: energy threshold relative to the noise floor
+        min_threshold: minimum energy (rms) threshold
+        zcr_threshold: zero-crossing rate above which low energy blocks are considered
+        adaptation: noise floor update rate (computed over the blocks considered silence)
+        """
+        self.block = int(sample_rate * block_ms / 1000)
+        self.factor = factor
+        self.min_threshold = min_threshold
+        self.zcr_threshold = zcr_threshold
+        self.adaptation = adaptation
+        self.noise_floor = None
+        self.offset = 0
+        self.active = []
+
+    def threshold(self):
+        return max(self.min_threshold, self.factor * self.noise_floor) if self.noise_floor is not None else self.min_threshold
+
+    def __call__(self, audio, start, end):
+        """
+        Analyses the blocks of audio[start:end] not analysed yet
+        Returns:
+        The position of the first block in [start, end) that may contain speech or None when none does
+        """
+        self.offset = max(self.offset, start)
+        n = (end - self.offset) // self.block
+        if n > 0:
+            blocks = audio[self.offset:self.offset + n*self.block].reshape(n, self.block)
+            energy = rms(blocks, axis=1)
+            if self.noise_floor is None:
+                self.noise_floor = float(np.percentile(energy, 10))
+            threshold = self.threshold()
+            silent = is_silence(blocks, threshold, axis=1) & ((energy < threshold / 2) | (zero_crossing_rate(blocks, axis=1) < self.zcr_threshold))
+            if silent.any():
+                floor = float(np.median(energy[silent]))
+                self.noise_floor = floor if floor < self.noise_floor else (1-self.adaptation) * self.noise_floor + self.adaptation * floor
+            for i in np.flatnonzero(~silent):
+                pos = self.offset + int(i) * self.block
+                if self.active and self.active[-1][1] == pos:
+                    self.active[-1][1] = pos + self.block
+                else:
+                    self.active.append([pos, pos + self.block])
+            self.offset += n * self.block
+        self.active = [a for a in self.active if a[1] > start]
+        logging.info('gate: noise_floor={:.4f} threshold={:.4f} active={}'.format(self.noise_floor or 0, self.threshold(), self.active))
+        return max(start, self.active[0][0]) if len(self.active) else None
+
+class StreamVAD():
+
+    def __init__(self, sample_rate=16000, options=VadOptions()):
+        """
+        Streaming version of get_speech_timestamps: the silero model state and the speech/silence state machine are kept
+        between calls, so that only the windows of window_size_samples captured since the previous call are processed
+        """
+        self.model = get_vad_model()
+        self.sample_rate = sample_rate
+        self.window = options.window_size_samples
+        self.threshold = options.threshold
+        self.neg_threshold = options.threshold - 0.15
+        self.min_speech_samples = sample_rate * options.min_speech_duration_ms / 1000
+        self.min_silence_samples = sample_rate * options.min_silence_duration_ms / 1000
+        self.speech_pad_samples = sample_rate * options.speech_pad_ms / 1000
+        self.reset(0)
+
+    def reset(self, offset):
+        """ restarts the analysis at position offset """
+        self.state = self.model.get_initial_state(batch_size=1)
+        self.offset = offset
+        self.triggered = False
+        self.current_start = 0
+        self.temp_end = 0
+        self.speeches = []
+
+    def __call__(self, audio, start, end):
+        """
+        Returns the speech chunks found in audio[start:end] (absolute positions) as get_speech_timestamps does
+        """
+        if start > self.offset:
+            self.reset(start)
+        n = (end - self.offset) // self.window
+        if n > 0:
+            data = audio[self.offset:self.offset + n*self.window]
+            for i in range(n):
+                speech_prob, self.state = self.model(data[i*self.window:(i+1)*self.window], self.state, self.sample_rate)
+                self.feed(speech_prob, self.offset)
+                self.offset += self.window
+        self.speeches = [s for s in self.speeches if s['end'] > start]
+        return self.speech_chunks(start, end)
+
+    def feed(self, speech_prob, pos):
+        """ state machine of get_speech_timestamps (max_speech_duration_s not considered) for the window starting at pos """
+        if speech_prob >= self.threshold and self.temp_end:
+            self.temp_end = 0
+        if speech_prob >= self.threshold and not self.triggered:
+            self.triggered = True
+            self.current_start = pos
+            return
+        if speech_prob < self.neg_threshold and self.triggered:
+            if not self.temp_end:
+                self.temp_end = pos
+            if pos - self.temp_end < self.min_silence_samples:
+                return
+            if self.temp_end - self.current_start > self.min_speech_samples:
+                self.speeches.append({'start': self.current_start, 'end': self.temp_end})
+            self.triggered = False
+            self.temp_end = 0
+
+    def speech_chunks(self, start, end):
+        """ closed speeches plus the ongoing one within [start, end), padded as get_speech_timestamps does """
+        speeches = [{'start': max(start, s['start']), 'end': s['end']} for s in self.speeches]
+        if self.triggered and end - max(start, self.current_start) > self.min_speech_samples:
+            speeches.append({'start': max(start, self.current_start), 'end': end})
+        for i, speech in enumerate(speeches):
+            if i == 0:
+                speech['start'] = int(max(start, speech['start'] - self.speech_pad_samples))
+            if i != len(speeches) - 1:
+                silence_duration = speeches[i+1]['start'] - speech['end']
+                if silence_duration < 2 * self.speech_pad_samples:
+                    speech['end'] += int(silence_duration // 2)
+                    speeches[i+1]['start'] = int(max(start, speeches[i+1]['start'] - silence_duration // 2))
+                else:
+                    speech['end'] = int(min(end, speech['end'] + self.speech_pad_samples))
+                    speeches[i+1]['start'] = int(max(start, speeches[i+1]['start'] - self.speech_pad_samples))
+            else:
+                speech['end'] = int(min(end, speech['end'] + self.speech_pad_samples))
+        return speeches
+
+class BatchStreamVAD():
+
+    def __init__(self, streams, sample_rate=16000, options=VadOptions()):
+        """
+        StreamVAD of several audio streams: the new windows of all the streams are processed by one silero call per window
+        position (the model state has a batch dimension of one row per stream), each stream keeps its own speech/silence state
+        """
+        self.vads = [StreamVAD(sample_rate, options) for _ in range(streams)]
+        self.model = self.vads[0].model
+        self.sample_rate = sample_rate
+        self.window = options.window_size_samples
+
+    def __len__(self):
+        return len(self.vads)
+
+    def __call__(self, windows):
+        """
+        windows: [(audio, start, end), ...] the window analysed in each stream (absolute positions)
+        Returns the speech chunks found in each window as StreamVAD does
+        """
+        steps = []
+        for vad, (audio, start, end) in zip(self.vads, windows):
+            if start > vad.offset:
+                vad.reset(start)
+            steps.append(max(0, (end - vad.offset) // self.window))
+        for i in range(max(steps, default=0)):
+            """ streams with fewer new windows drop out of the batch """
+            batch = [s for s, n in enumerate(steps) if i < n]
+            x = np.stack([windows[s][0][self.vads[s].offset:self.vads[s].offset + self.window] for s in batch])
+            h = np.concatenate([self.vads[s].state[0] for s in batch], axis=1)
+            c = np.concatenate([self.vads[s].state[1] for s in batch], axis=1)
+            speech_probs, (h, c) = self.model(x, (h, c), self.sample_rate)
+            for j, s in enumerate(batch):
+                vad = self.vads[s]
+                vad.state = (h[:, j:j+1], c[:, j:j+1])
+                vad.feed(float(np.asarray(speech_probs[j]).reshape(-1)[0]), vad.offset)
+                vad.offset += self.window
+        """ the windows are now analysed: the streams only select their speech chunks """
+        return [vad(audio, start, end) for vad, (audio, start, end) in zip(self.vads, windows)]
+
 class VAD():
 
-    def __init__(self, audio, start, end, sample_rate, min_silence_sec, padding_sec):
+    def __init__(self, audio, start, end, sample_rate, min_silence_sec, padding_sec, stream_vad=None, speech_chunks=None):
+        """ 
+        speech chunks of audio[start:end] are computed by stream_vad (StreamVAD) if given, otherwise running silero over the whole window 
+        (speech_chunks, absolute positions, are used when given: VAD run by the server)
+        """
         self.start = start
         self.end = end
         self.sample_rate = sample_rate
         self.min_silence_sec = min_silence_sec
         self.padding_sec = padding_sec
-        self.speech_chunks = get_speech_timestamps(audio[start:end], VadOptions())
-        for i in range(len(self.speech_chunks)):
-            ''' add audio_start to make start/end indexs refer to the begining of self.audio (rather than audio_start) '''
-            self.speech_chunks[i]['start'] += start
-            self.speech_chunks[i]['end'] += start
+        if speech_chunks is not None:
+            self.speech_chunks = speech_chunks
+        elif stream_vad is not None:
+            self.speech_chunks = stream_vad(audio, start, end)
+        else:
+            self.speech_chunks = get_speech_timestamps(audio[start:end], VadOptions())
+            for i in range(len(self.speech_chunks)):
+                ''' add audio_start to make start/end indexs refer to the begining of self.audio (rather than audio_start) '''
+                self.speech_chunks[i]['start'] += start
+                self.speech_chunks[i]['end'] += start
         logging.info('vad: found {} speech chunks, audio_start={} {} audio_end={}'.format(len(self.speech_chunks), start, self.speech_chunks, end))
 
     def __len__(self):
@@ -0,0 +1,119 @@
+import json
+import asyncio
+import logging
+import threading
+import websockets
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from python.Codec import decode
+from python.Scheduler import Coalesced, Shed
+
+class WebSocketServer():
+
+    def __init__(self, asr, sessions, host='0.0.0.0', port=5001, sample_rate=16000, max_decodes=64, partial_beam_size=0):
+        """
+        Bidirectional streaming endpoint. Messages sent by the client:
+        {'type': 'open', 'language': ..., 'beam_size': ..., 'task': ..., 'encoding': ..., 'model': ..., 'compute_type': ...} opens the stream (a server session)
+        binary frames: audio captured (encoded as indicated when opening), appended to the session audio
+        {'type': 'decode', 'start': s, 'end': e, 'history': ...} transcribes the session audio [s, e) (optional 'speech_chunks' 
+        relative to s skip the server VAD)
+        {'type': 'commit', 'offset': n, 'text': ...} releases the audio before n (text is the transcript finalized by the client)
+        Messages pushed by the server (json):
+        {'type': 'opened', 'session': sid}
+        {'type': 'language', 'window': [s, e], ...} and {'type': 'word', 'window': [s, e], 'word': [start, end, word]} as soon as decoded
+        {'type': 'hyp', 'window': [s, e], 'transcript': {...}} when the decoding of window [s, e) ends ('transcript' as in /transcribe)
+        {'type': 'coalesced'|'shed'|'error', 'window': [s, e], 'error': ...} when the decoding of window [s, e) failed
+        {'type': 'final', 'start': s, 'end': e, 'text': ...} when the client commits a transcript
+        Params:
+        asr: Scheduler (or StreamASR) decoding the requests, called from an executor
+        sessions: SessionStore keeping the audio of streams
+        max_decodes: maximum number of blocking decodes waiting in the executor
+        partial_beam_size: beam size of the decodes (partial requests), 0: as requested
+        """
+        self.asr = asr
+        self.sessions = sessions
+        self.host = host
+        self.port = port
+        self.sample_rate = sample_rate
+        self.partial_beam_size = partial_beam_size
+        self.executor = ThreadPoolExecutor(max_workers=max_decodes, thread_name_prefix='ws-decode')
+
+    def start(self):
+        """ runs the asyncio event loop in a background thread """
+        threading.Thread(target=asyncio.run, args=(self.serve(),), name='websocket', daemon=True).start()
+
+    async def serve(self):
+        async with websockets.serve(self.handler, self.host, self.port, max_size=None):
+            logging.info('WebSocketServer listening on {}:{}'.format(self.host, self.port))
+            await asyncio.Future()
+
+    async def handler(self, websocket):
+        loop = asyncio.get_running_loop()
+        outbox = asyncio.Queue()
+        sender = asyncio.create_task(self.sender(websocket, outbox))
+        def push(event):
+            """ thread-safe: called from the decoding threads """
+            loop.call_soon_threadsafe(outbox.put_nowait, event)
+        session = None
+        encoding = 'float32'
+        try:
+            async for message in websocket:
+                if isinstance(message, bytes):
+                    if session is not None:
+                        session.append(decode(message, encoding, self.sample_rate), session.end)
+                    continue
+                msg = json.loads(message)
+                if msg['type'] == 'open':
+                    encoding = msg.get('encoding', 'float32')
+                    session = self.sessions.open({k: msg.get(k) for k in ('language', 'beam_size', 'task', 'model', 'compute_type')})
+                    session.trim(int(msg.get('offset', 0)))
+                    outbox.put_nowait({'type': 'opened', 'session': session.sid})
+                elif session is None:
+                    outbox.put_nowait({'type': 'error', 'error': 'stream not opened'})
+                elif msg['type'] == 'decode':
+                    start, end, audio = session.window(int(msg['start']), int(msg['end']))
+                    options = dict(session.options, **{k: v for k, v in msg.items() if k in ('language', 'beam_size', 'task', 'history')})
+                    if msg.get('speech_chunks') is not None:
+                        options['speech_chunks'] = session.clip_chunks(msg['speech_chunks'], int(msg['start']), start, end)
+                    loop.run_in_executor(self.executor, self.decode, session.sid, start, end, audio, options, push)
+                elif msg['type'] == 'commit':
+                    session.trim(int(msg['offset']))
+                    outbox.put_nowait({'type': 'final', 'start': msg.get('start'), 'end': msg['offset'], 'text': msg.get('text')})
+        except (websockets.ConnectionClosed, KeyError, ValueError, RuntimeError) as e:
+            logging.info('websocket closed: {}'.format(e))
+        finally:
+            if session is not None:
+                self.sessions.close(session.sid)
+            sender.cancel()
+
+    async def sender(self, websocket, outbox):
+        while True:
+            event = await outbox.get()
+            try:
+                await websocket.send(json.dumps(event))
+            except websockets.ConnectionClosed:
+                return
+
+    def decode(self, sid, start, end, audio, options, push):
+        """ blocking decode of session sid window [start, end), results are pushed as they are produced """
+        try:
+            transcript = self.asr(
+                np.asarray(audio, dtype=np.float32),
+                stream=sid,
+                window=[start, end],
+                language=options.get('language'),
+                history=options.get('history'),
+                beam_size=self.partial_beam_size or int(options.get('beam_size') or 5),
+                task=options.get('task') or 'transcribe',
+                model_size=options.get('model'),
+                compute_type=options.get('compute_type'),
+                speech_chunks=options.get('speech_chunks'),
+                on_event=lambda event: push(dict(event, window=[start, end])))
+            push({'type': 'hyp', 'window': [start, end], 'transcript': transcript})
+        except Coalesced as e:
+            push({'type': 'coalesced', 'window': [start, end], 'error': str(e)})
+        except Shed as e:
+            push({'type': 'shed', 'window': [start, end], 'error': str(e)})
+        except Exception as e:
+            logging.exception('websocket decode failed')
+            push({'type': 'error', 'window': [start, end], 'error': str(e)})
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import glob
+import time
+import shlex
+import logging
+import argparse
+import resource
+import subprocess
+import contextlib
+import requests
+import numpy as np
+from python.StreamMic import StreamMic
+from python.AudioSource import FileSource
+from python.Codec import ENCODINGS
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    return {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99)), 'mean': float(np.mean(values)), 'n': len(values)}
+
+def cpu_sec(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def start_server(server_args, port, timeout):
+    """ launches streaming-asr_server.py on port and waits until /ready answers (its models are loaded) """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streaming-asr_server.py')
+    process = subprocess.Popen([sys.executable, script, '--host', '127.0.0.1', '--port', str(port)] + shlex.split(server_args))
+    tic = time.time()
+    while time.time() - tic < timeout:
+        if process.poll() is not None:
+            raise SystemExit('server exited with code {}'.format(process.returncode))
+        try:
+            if requests.get('http://127.0.0.1:{}/ready'.format(port), timeout=1).status_code == 200:
+                logging.info('server ready after {:.1f} seconds'.format(time.time() - tic))
+                return process
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise SystemExit('server not ready after {} seconds'.format(timeout))
+
+def run(path, args, url_api):
+    """ replays path through a StreamMic client, returns its measures """
+    source = FileSource(path, 1, args.block_size, args.sample_rate, args.speed)
+    m = StreamMic(
+        args.task,
+        args.beam_size,
+        1,
+        args.block_size,
+        args.sample_rate,
+        args.sleep,
+        url_api,
+        args.language,
+        args.silence,
+        args.endchars,
+        args.skip_ini,
+        args.skip_end,
+        args.padding,
+        encoding=args.encoding,
+        session=args.session,
+        stream_vad=args.stream_vad,
+        energy_gate=args.energy_gate,
+        stream_words=args.stream_words,
+        inflight=args.inflight,
+        vad=args.vad,
+        agreement=args.agreement,
+        max_window_ms=args.max_window,
+        adaptive=args.adaptive,
+        min_sleep_ms=args.min_sleep,
+        max_sleep_ms=args.max_sleep,
+        model=args.model,
+        compute_type=args.compute_type,
+        source=source)
+    tic = time.time()
+    m()
+    wall_sec = time.time() - tic
+    m.close()
+    stats = m.stats
+    return {
+        'file': path,
+        'duration_sec': source.duration,
+        'wall_sec': wall_sec,
+        'rtf_wall': wall_sec / source.duration,
+        'rtf_asr': sum(stats['time_ASR']) / source.duration,
+        'requests': len(stats['time_ASR']),
+        'requests_skipped': len(stats['n_SKIPPED']),
+        'interval_sec': percentiles(stats['time_INTERVAL']),
+        'tick_latency_sec': percentiles(stats['time_TICK']),
+        'handled_latency_sec': percentiles(stats['time_HANDLED']),
+        'asr_latency_sec': percentiles(stats['time_ASR']),
+        'first_word_sec': percentiles(stats['time_FIRSTWORD']),
+        'commit_lag_sec': percentiles(stats['time_COMMIT_LAG']),
+        'bytes_sent': int(sum(stats['bytes_SENT'])),
+        'failed': len(stats['n_FAILED']),
+        'transcripts': [t['str'] for t in m.transcripts]}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='This script replays audio files through the streaming client and reports latency and throughput measures (json).', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('corpus', type=str, nargs='+', help='Audio files (wav, flac, ...) or directories containing them')
+    group_server = parser.add_argument_group("Server")
+    group_server.add_argument('--url_api', type=str, help='Address of the ASR server(s) to use, a local server is launched when not given', default=None)
+    group_server.add_argument('--server_args', type=str, help='Arguments of the local server (e.g. --server_args="--model_size tiny --replicas 2")', default='')
+    group_server.add_argument('--port', type=int, help='Port of the local server', default=5123)
+    group_server.add_argument('--server_timeout', type=int, help='Maximum time (seconds) waiting for the local server to be ready', default=600)
+    group_client = parser.add_argument_group("Client (see streaming-asr_client.py)")
+    group_client.add_argument('--speed', type=float, help='Replay rate of the audio files (1.0: real time)', default=1.0)
+    group_client.add_argument('--block_size', type=int, default=1024)
+    group_client.add_argument('--sample_rate', type=int, default=16000)
+    group_client.add_argument('--beam_size', type=int, default=5)
+    group_client.add_argument('--language', type=str, default=None)
+    group_client.add_argument('--task', type=str, default='transcribe')
+    group_client.add_argument('--model', type=str, default=None)
+    group_client.add_argument('--compute_type', type=str, default=None)
+    group_client.add_argument('--sleep', type=int, default=500)
+    group_client.add_argument('--adaptive', action='store_true')
+    group_client.add_argument('--min_sleep', type=int, default=100)
+    group_client.add_argument('--max_sleep', type=int, default=0)
+    group_client.add_argument('--silence', type=int, default=500)
+    group_client.add_argument('--endchars', type=str, default=',.!?؟،')
+    group_client.add_argument('--skip_ini', type=int, default=3)
+    group_client.add_argument('--skip_end', type=int, default=3)
+    group_client.add_argument('--padding', type=int, default=200)
+    group_client.add_argument('--encoding', type=str, choices=('json',)+ENCODINGS, default='float32')
+    group_client.add_argument('--session', action='store_true')
+    group_client.add_argument('--stream_vad', action='store_true')
+    group_client.add_argument('--energy_gate', action='store_true')
+    group_client.add_argument('--stream_words', action='store_true')
+    group_client.add_argument('--inflight', type=int, default=0)
+    group_client.add_argument('--vad', type=str, choices=('both', 'client', 'server'), default='both')
+    group_client.add_argument('--agreement', type=int, default=0)
+    group_client.add_argument('--max_window', type=int, default=0)
+    group_other = parser.add_argument_group("Other")
+    group_other.add_argument('--output', type=str, help='Write the results to this file (default: standard output)', default=None)
+    group_other.add_argument('--debug', action='store_true', help='Debug mode')
+    args = parser.parse_args()
+    if args.session and args.inflight > 1:
+        parser.error('--session uploads the audio sequentially: use --inflight 0 or 1 with it')
+    logging.basicConfig(
+        format='[%(asctime)s.%(msecs)03d] %(levelname)s %(message)s',
+        datefmt='%Y-%m-%d_%H:%M:%S',
+        level=getattr(logging, 'WARNING' if not args.debug else 'INFO'),
+        filename=None)
+
+    files = []
+    for path in args.corpus:
+        files += sorted(f for f in glob.glob(os.path.join(path, '*')) if os.path.splitext(f)[1].lower() in ('.wav', '.flac', '.ogg')) if os.path.isdir(path) else [path]
+
+    server = start_server(args.server_args, args.port, args.server_timeout) if args.url_api is None else None
+    url_api = args.url_api or 'http://127.0.0.1:{}/transcribe'.format(args.port)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results = []
+    try:
+        """ the hypotheses and transcripts printed by the client go to stderr, stdout only receives the results """
+        with contextlib.redirect_stdout(sys.stderr):
+            for path in files:
+                logging.warning('replaying {}'.format(path))
+                results.append(run(path, args, url_api))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    client_usage = resource.getrusage(resource.RUSAGE_SELF)
+    duration = sum(r['duration_sec'] for r in results)
+    report = {
+        'config': vars(args),
+        'duration_sec': duration,
+        'client_cpu_sec': cpu_sec(client_usage) - cpu_sec(usage),
+        'client_peak_rss_mb': client_usage.ru_maxrss / 1024,
+        'bytes_sent': sum(r['bytes_sent'] for r in results),
+        'files': results}
+    if server is not None:
+        server_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        report['server_cpu_sec'] = cpu_sec(server_usage)
+        report['server_peak_rss_mb'] = server_usage.ru_maxrss / 1024
+        report['rtf_cpu'] = (report['client_cpu_sec'] + report['server_cpu_sec']) / max(duration, 1e-9)
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as fdesc:
+            fdesc.write(output + '\n')
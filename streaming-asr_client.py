@@ -2,21 +2,46 @@ import sys
 import logging
 import argparse
 from python.StreamMic import StreamMic
+from python.AsyncStreamMic import AsyncStreamMic
+from python.MultiStreamMic import MultiStreamMic
+from python.AudioSource import FileSource
+from python.Codec import ENCODINGS
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='This script reads audio data from the available microphone and performs ASR.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     group_server = parser.add_argument_group("Server")
-    group_server.add_argument('--url_api', type=str, help='Address where ASR server is located', default='http://10.25.1.145:5000/transcribe')
-    group_server.add_argument('--channels', type=int, help='Channels (1:mono, 2:stereo)', default=1)
+    group_server.add_argument('--url_api', type=str, help='Address where ASR server is located (comma-separated list of addresses to balance requests over several servers)', default='http://10.25.1.145:5000/transcribe')
+    group_server.add_argument('--routing', type=str, help='Servers receiving requests: the one with least outstanding requests or with lowest expected latency', choices=('least', 'latency'), default='least')
+    group_server.add_argument('--health', type=int, help='Interval (ms) between health checks of the servers, failing servers come back once healthy (0: no health checks)', default=2000)
+    group_server.add_argument('--channels', type=int, help='Channels captured, each channel is transcribed as a separate stream (1: mono)', default=1)
+    group_server.add_argument('--devices', type=str, help='Comma-separated list of input devices (ids or names) captured, each device is transcribed as a separate stream (default: the default device)', default=None)
     group_server.add_argument('--block_size', type=int, help='Amount of audio data captured', default=1024)
     group_server.add_argument('--sample_rate', type=int, help='Sample rate', default=16000)
     group_server.add_argument('--beam_size', type=int, help='Decoding beam size', default=5)
     group_server.add_argument('--language', type=str, help='Force language when transcribing', default=None)
+    group_server.add_argument('--model', type=str, help='Model of the server decoding the requests (one of its --models, default: the server --model_size)', default=None)
+    group_server.add_argument('--compute_type', type=str, help='Compute type of --model (default: the server --compute_type)', default=None)
     group_server.add_argument('--task', type=str, help='Task to perform: transcribe or translate', default='transcribe')
+    group_server.add_argument('--url_ws', type=str, help='Address of the websocket streaming endpoint (ws://host:port), used instead of --url_api when given', default=None)
+    group_server.add_argument('--stream_words', action='store_true', help='Receive words as soon as decoded (newline-delimited json response), [endchars] transcripts are created without waiting for the whole decoding')
+    group_server.add_argument('--final', action='store_true', help='Transcripts are re-decoded by the final (larger) model of the server, the final text replaces the transcript')
+    group_server.add_argument('--session', action='store_true', help='Use a server session: only new audio is uploaded, the server keeps the audio window')
+    group_server.add_argument('--encoding', type=str, help='Audio sent as json float lists or as binary (float32, int16 PCM or flac compressed)', choices=('json',)+ENCODINGS, default='float32')
 
     group_client = parser.add_argument_group("Client")
+    group_client.add_argument('--replay', type=str, help='Replay this audio file (wav, flac, ...) instead of capturing the microphone', default=None)
+    group_client.add_argument('--speed', type=float, help='Replay rate of --replay (1.0: real time)', default=1.0)
     group_client.add_argument('--sleep', type=int, help='ASR requests performed every this amount of time (ms)', default=500)
+    group_client.add_argument('--adaptive', action='store_true', help='Adaptive interval between requests: no request while the speech window is unchanged, shorter intervals once speech ended (--min_sleep), longer while decoding is slower than the interval (--max_sleep)')
+    group_client.add_argument('--min_sleep', type=int, help='Minimum interval (ms) between requests with --adaptive', default=100)
+    group_client.add_argument('--max_sleep', type=int, help='Maximum interval (ms) between requests when decoding is slow or the server overloaded (0: 8 times --sleep)', default=0)
+    group_client.add_argument('--buffer', type=int, help='Capture buffer size (seconds), older audio is released (transcripts are archived in --odir as soon as created)', default=300)
+    group_client.add_argument('--vad', type=str, help='VAD run by the client and the server, by the client only (the server decodes the client speech chunks) or by the server only (the whole window is sent)', choices=('both', 'client', 'server'), default='both')
+    group_client.add_argument('--stream_vad', action='store_true', help='Streaming VAD: only audio captured since the previous request is processed (VAD state is kept)')
+    group_client.add_argument('--energy_gate', action='store_true', help='Run the VAD only when the energy of some audio block crosses an adaptive noise floor threshold')
+    group_client.add_argument('--deadline', type=int, help='Time budget (ms) of ASR requests, the server rejects requests that cannot meet it (0: no deadline)', default=0)
+    group_client.add_argument('--inflight', type=int, help='Pipelined client: the VAD runs in its own thread and up to this number of ASR requests are pending at once (0: sequential analysis)', default=0)
     group_client.add_argument('--padding', type=int, help='Speech intervals are padded by this amount of time (ms) each side', default=200)
 
     group_client_endsilence = parser.add_argument_group("  ===== Create a [endsilence] transcript when long silences detected =====")
@@ -27,17 +52,34 @@ if __name__ == '__main__':
     group_client_endchars.add_argument('--skip_ini', type=int, help='Skip these initial tokens when searching [endchars] transcript', default=3)
     group_client_endchars.add_argument('--skip_end', type=int, help='Skip these ending tokens when searching [endchars] transcript', default=3)
 
+    group_client_agreement = parser.add_argument_group("  ===== Create a [agreement] transcript when the initial tokens of the hypothesis are the same over consecutive requests =====")
+    group_client_agreement.add_argument('--agreement', type=int, help='Tokens (text and end time) that are the same in the hypotheses of this number of consecutive requests produce a transcript [agreement] (0: disabled)', default=0)
+    group_client_agreement.add_argument('--max_window', type=int, help='Maximum audio (ms) sent in a request, a [maxwindow] transcript is created when the hypothesis reaches it (0: no limit)', default=0)
+
     group_other = parser.add_argument_group("Other")
-    group_other.add_argument('--odir', type=str, help='Save transcripts in directory', default=None)
+    group_other.add_argument('--odir', type=str, help='Archive transcripts in directory as they are created (transcripts.jsonl and the audio of each transcript in flac)', default=None)
+    group_other.add_argument('--stats', type=int, help='Print the stats every this amount of time (seconds) (0: only when finished)', default=0)
     group_other.add_argument('--debug', action='store_true', help='Debug mode')
     args = parser.parse_args()
+    if args.session and args.inflight > 1:
+        parser.error('--session uploads the audio sequentially: use --inflight 0 or 1 with it')
     logging.basicConfig(
         format='[%(asctime)s.%(msecs)03d] %(levelname)s %(message)s', 
         datefmt='%Y-%m-%d_%H:%M:%S', 
         level=getattr(logging, 'WARNING' if not args.debug else 'INFO'), 
         filename=None)    
 
-    m = StreamMic(
+    """ the websocket client pushes audio as captured and receives words as decoded, several streams are transcribed by one MultiStreamMic """
+    devices = [int(d) if d.isdigit() else d for d in args.devices.split(',')] if args.devices else None
+    if args.final and args.url_ws is not None:
+        parser.error('final re-decoding (--final) is only available with http requests (--url_api)')
+    if (args.channels > 1 or devices) and args.url_ws is not None:
+        parser.error('several streams (--channels, --devices) are only transcribed with http requests (--url_api)')
+    if args.channels > 1 or devices:
+        stream_class, stream_kwargs = MultiStreamMic, {'devices': devices}
+    else:
+        stream_class, stream_kwargs = (AsyncStreamMic, {'url_ws': args.url_ws}) if args.url_ws is not None else (StreamMic, {})
+    m = stream_class(
         args.task, 
         args.beam_size, 
         args.channels, 
@@ -50,14 +92,36 @@ if __name__ == '__main__':
         args.endchars, 
         args.skip_ini, 
         args.skip_end, 
-        args.padding)
+        args.padding,
+        encoding=args.encoding,
+        session=args.session,
+        buffer_sec=args.buffer,
+        archive_dir=args.odir,
+        adaptive=args.adaptive,
+        min_sleep_ms=args.min_sleep,
+        max_sleep_ms=args.max_sleep,
+        stream_vad=args.stream_vad,
+        energy_gate=args.energy_gate,
+        deadline_ms=args.deadline,
+        stream_words=args.stream_words,
+        inflight=args.inflight,
+        routing=args.routing,
+        health_ms=args.health,
+        final=args.final,
+        vad=args.vad,
+        agreement=args.agreement,
+        max_window_ms=args.max_window,
+        stats_sec=args.stats,
+        model=args.model,
+        compute_type=args.compute_type,
+        source=FileSource(args.replay, args.channels, args.block_size, args.sample_rate, args.speed) if args.replay is not None else None,
+        **stream_kwargs)
     print('Listening... use [Ctrl+c] to terminate streaming', file=sys.stderr)
     try:
         m()
     except KeyboardInterrupt:
         print('KeyboardInterrupt: recording finished', file=sys.stderr)
-        if args.odir is not None:
-            m.save_transcripts(args.odir)
+    m.close()
     m.print_stats()
 
 
@@ -1,9 +1,19 @@
+import json
+import time
+import queue
 import logging
 import argparse
+import threading
+import numpy as np
 from datetime import datetime
 from faster_whisper import WhisperModel
-from flask import Flask, request, jsonify
-from python.StreamASR import StreamASR
+from flask import Flask, Response, request, jsonify, g
+from python.StreamASR import StreamASR, ModelRegistry
+from python.Codec import decode, decode_options
+from python.Sessions import SessionStore
+from python.Scheduler import Scheduler, Job, Coalesced, Shed
+from python.WebSocketServer import WebSocketServer
+from python.Metrics import Metrics, SampledProfiler
 
 if __name__ == '__main__':
 
@@ -12,27 +22,309 @@ if __name__ == '__main__':
     group_model.add_argument('--model_size', type=str, help='Model size (tiny.en, tiny, base.en, base, small.en, small, medium.en, medium, large-v1, large-v2)', default='tiny')
     group_model.add_argument('--device', type=str, help='Device: cpu, cuda, auto', default='auto')
     group_model.add_argument('--compute_type', type=str, help='Compute type', default='int8')
+    group_model.add_argument('--cpu_threads', type=int, help='CTranslate2 threads per model when running on CPU (0: default)', default=0)
+    group_model.add_argument('--num_workers', type=int, help='CTranslate2 workers per replica (requests of a batch decoded in parallel), models are shared by the replicas', default=1)
+    group_model.add_argument('--replicas', type=int, help='Number of model replicas', default=1)
+    group_model.add_argument('--partial_beam_size', type=int, help='Beam size of partial requests (1: greedy decoding, 0: as requested)', default=0)
+    group_model.add_argument('--final_model_size', type=str, help='Model re-decoding the transcripts finalized by clients (final requests), partial requests use --model_size (default: --model_size for all requests)', default=None)
+    group_model.add_argument('--final_replicas', type=int, help='Number of replicas of the final model', default=1)
+    group_registry = parser.add_argument_group("Model registry")
+    group_registry.add_argument('--models', type=str, help='Comma-separated list of other model sizes that requests can select (option model, with option compute_type), loaded on first use', default='')
+    group_registry.add_argument('--memory_budget_mb', type=int, help='Estimated memory (MB) of the models kept loaded, the least recently used are evicted beyond (0: no limit)', default=0)
+    group_registry.add_argument('--preload', action='store_true', help='Load the models of --models at startup (--model_size and --final_model_size are always loaded)')
+    group_registry.add_argument('--warmup', action='store_true', help='Run a short dummy decoding after loading a model')
+    group_scheduler = parser.add_argument_group("Scheduler")
+    group_scheduler.add_argument('--max_batch_size', type=int, help='Maximum number of compatible requests (same beam_size/task/language) decoded together', default=1)
+    group_scheduler.add_argument('--max_wait_ms', type=int, help='Maximum time (ms) a request waits for compatible requests to fill its batch', default=0)
     group_server = parser.add_argument_group("Server")
     group_server.add_argument('--host', type=str, help='Host used (use 0.0.0.0 to allow distant access, otherwise use 127.0.0.1)', default='0.0.0.0')
     group_server.add_argument('--port', type=int, help='Port used in local server', default=5000)
+    group_server.add_argument('--ws_port', type=int, help='Port of the websocket streaming endpoint (0: disabled)', default=0)
+    group_server.add_argument('--sample_rate', type=int, help='Sample rate of the audio received', default=16000)
+    group_session = parser.add_argument_group("Sessions")
+    group_session.add_argument('--session_ttl', type=int, help='Sessions idle for more than this amount of time (seconds) are evicted', default=60)
+    group_session.add_argument('--session_max_sec', type=int, help='Maximum amount of audio (seconds) kept per session', default=120)
+    group_session.add_argument('--max_sessions', type=int, help='Maximum number of sessions opened at the same time', default=500)
+    group_metrics = parser.add_argument_group("Metrics")
+    group_metrics.add_argument('--profile_rate', type=float, help='Fraction of the requests decoded profiled with cProfile (0: disabled)', default=0.0)
+    group_metrics.add_argument('--profile_slow_ms', type=int, help='Profiles of requests decoded slower than this (ms) are logged', default=1000)
+    group_metrics.add_argument('--profile_dir', type=str, help='Directory where the profiles logged are saved (pstats files)', default=None)
     args = parser.parse_args()
     logging.basicConfig(format='[%(asctime)s.%(msecs)03d] %(levelname)s %(message)s', datefmt='%Y-%m-%d_%H:%M:%S', level=getattr(logging, 'INFO', None), filename='./log.{}'.format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S")))
-    asr = StreamASR(args.model_size, args.device, args.compute_type)
+    """ metrics exposed in the Prometheus text format by GET /metrics """
+    metrics = Metrics()
+    profiler = SampledProfiler(args.profile_rate, args.profile_slow_ms, args.profile_dir)
+    """ models loaded once and shared by the replicas of both schedulers, so their workers serve all the replicas """
+    models = [args.model_size] + ([args.final_model_size] if args.final_model_size else []) + [m for m in args.models.split(',') if m]
+    registry = ModelRegistry(
+        args.device, 
+        args.cpu_threads, 
+        args.num_workers * max(args.replicas, args.final_replicas), 
+        args.memory_budget_mb, 
+        models, 
+        args.warmup, 
+        metrics)
+    asr = Scheduler(
+        [StreamASR(args.model_size, args.device, args.compute_type, args.cpu_threads, args.num_workers, metrics, registry, profiler) for _ in range(args.replicas)], 
+        args.max_batch_size, 
+        args.max_wait_ms,
+        args.sample_rate,
+        'main',
+        metrics)
+    """ final requests (transcripts finalized by the client) are decoded by the larger model when given """
+    final_asr = Scheduler(
+        [StreamASR(args.final_model_size, args.device, args.compute_type, args.cpu_threads, args.num_workers, metrics, registry, profiler) for _ in range(args.final_replicas)], 
+        args.max_batch_size, 
+        args.max_wait_ms,
+        args.sample_rate,
+        'final',
+        metrics) if args.final_model_size else asr
+    sessions = SessionStore(args.session_ttl, args.session_max_sec, args.max_sessions, args.sample_rate)
+    http_requests = metrics.counter('asr_http_requests_total', 'HTTP requests by route, method and status')
+    http_errors = metrics.counter('asr_http_errors_total', 'HTTP requests answered with an error status (4xx, 5xx) by route')
+    http_in_flight = metrics.gauge('asr_http_requests_in_flight', 'HTTP requests being handled')
+    time_request = metrics.histogram('asr_http_request_seconds', 'Time handling the HTTP requests (until the response starts) by route')
+    time_parse = metrics.histogram('asr_request_parse_seconds', 'Time parsing the transcription requests (audio decoding included)')
+    time_audio_decode = metrics.histogram('asr_audio_decode_seconds', 'Time decoding the audio of binary requests by encoding')
+    audio_length = metrics.histogram('asr_request_audio_seconds', 'Length of the audio of the transcription requests', buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120))
+    time_serialize = metrics.histogram('asr_response_serialization_seconds', 'Time serializing the responses and streamed events (json)')
+    metrics.gauge('asr_sessions', 'Sessions opened', function=lambda: len(sessions))
+
+    """ the server answers while the models are loaded, /ready tells when they are """
+    ready = threading.Event()
+    def preload():
+        for model in (models if args.preload else models[:2 if args.final_model_size else 1]):
+            try:
+                registry.get(model, args.compute_type)
+            except RuntimeError as e:
+                logging.error(str(e))
+                return
+        logging.info('models loaded: {}'.format(registry.loaded()))
+        ready.set()
+    threading.Thread(target=preload, name='preload', daemon=True).start()
 
     app = Flask(__name__)
+
+    @app.before_request
+    def before_request():
+        g.tic = time.time()
+        http_in_flight.inc()
+
+    @app.after_request
+    def after_request(response):
+        route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        http_requests.inc(route=route, method=request.method, status=response.status_code)
+        if response.status_code >= 400:
+            http_errors.inc(route=route)
+        time_request.observe(time.time() - g.tic, route=route)
+        return response
+
+    @app.teardown_request
+    def teardown_request(error):
+        http_in_flight.dec()
+
+    def parse_request():
+        """
+        Requests are either json ({'audio': [floats], 'language': ..., 'history': ..., 'beam_size': ..., 'task': ...})
+        or binary: the body contains the audio wave encoded as indicated by the X-Audio-Encoding header (float32, int16 or flac)
+        and decoding options are sent in the X-Options header (see python/Codec.py)
+        """
+        with time_parse.time():
+            if request.is_json:
+                content = request.json
+                return content['audio'], content
+            encoding = request.headers.get('X-Audio-Encoding', 'float32')
+            body = request.get_data()
+            with time_audio_decode.time(encoding=encoding):
+                audio = decode(body, encoding, args.sample_rate)
+            return audio, decode_options(request.headers.get('X-Options'))
+
+    def transcribe(audio, content, **response):
+        """
+        Transcribes audio with the decoding options in content. Optional scheduling options:
+        stream: identifier of the client stream, window: [start, end) of audio in the stream (newer requests of a stream 
+        containing the window of an older one supersede it), deadline_ms: time budget of the request, speech_chunks: speech regions found by 
+        the client VAD (sample positions in audio), the server VAD is then skipped.
+        Requests with final=true are decoded by the final model, partial requests by the fast model (with --partial_beam_size),
+        unless they select a model of the registry (options model and compute_type).
+        Returns a flask response: 200 with the transcript, 400 when the model is not available, 409 when superseded, 503 when the deadline cannot be met.
+        The X-Queue-Wait header contains the estimated queue wait (seconds) so that clients can adapt their request rate.
+        When the request accepts application/x-ndjson (or text/event-stream) the response is streamed: one json line (event) 
+        per language info and word as soon as decoded, then the complete transcript {'type': 'hyp', 'transcript': ...}
+        """
+        events = queue.Queue()
+        audio_length.observe(len(audio) / args.sample_rate)
+        streaming = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson', 'text/event-stream']) in ('application/x-ndjson', 'text/event-stream')
+        final = bool(content.get('final'))
+        scheduler = final_asr if final else asr
+        try:
+            registry.check(content.get('model') or scheduler.replicas[0].model_size, content.get('compute_type') or args.compute_type)
+        except ValueError as e:
+            return jsonify({'status': 'unavailable', 'error': str(e)}), 400
+        beam_size = int(content.get('beam_size', 5)) if final or not args.partial_beam_size else args.partial_beam_size
+        job = scheduler.submit(Job(
+            audio,
+            stream=content.get('stream'),
+            window=content.get('window'),
+            deadline=time.time() + float(content['deadline_ms'])/1000 if content.get('deadline_ms') else None,
+            language=content.get('language'),
+            history=content.get('history'),
+            beam_size=beam_size,
+            task=content.get('task', 'transcribe'),
+            model_size=content.get('model'),
+            compute_type=content.get('compute_type'),
+            speech_chunks=content.get('speech_chunks'),
+            on_event=events.put if streaming else None))
+        if streaming and not job.done.is_set():
+            return stream_events(job, events, response, scheduler)
+        try:
+            response['transcript'] = job.wait()
+            status = 200
+        except Coalesced as e:
+            response, status = {'status': 'coalesced', 'error': str(e)}, 409
+        except Shed as e:
+            response, status = {'status': 'shed', 'error': str(e)}, 503
+        with time_serialize.time():
+            body = jsonify(response)
+        return body, status, load_headers(status, scheduler)
+
+    def load_headers(status, scheduler):
+        queue_wait = scheduler.estimated_wait()
+        headers = {'X-Queue-Wait': '{:.3f}'.format(queue_wait)}
+        if status == 503:
+            headers['Retry-After'] = str(max(1, int(queue_wait+0.5)))
+        return headers
+
+    def stream_events(job, events, response, scheduler):
+        sse = request.accept_mimetypes.best_match(['application/x-ndjson', 'text/event-stream']) == 'text/event-stream'
+        def line(event):
+            with time_serialize.time():
+                data = json.dumps(dict(event, **response))
+            return 'data: {}\n\n'.format(data) if sse else data + '\n'
+        def generate():
+            try:
+                while True:
+                    event = events.get()
+                    if event is None:
+                        break
+                    yield line(event)
+                try:
+                    yield line({'type': 'hyp', 'transcript': job.wait()})
+                except Coalesced as e:
+                    yield line({'type': 'coalesced', 'error': str(e)})
+                except Shed as e:
+                    yield line({'type': 'shed', 'error': str(e)})
+                except Exception as e:
+                    yield line({'type': 'error', 'error': str(e)})
+            except GeneratorExit:
+                """ the client closed the connection: the decoding stops after the current segment """
+                job.cancelled.set()
+                raise
+        """ events are followed by None once the job is done """
+        threading.Thread(target=lambda: (job.done.wait(), events.put(None)), daemon=True).start()
+        return Response(generate(), mimetype='text/event-stream' if sse else 'application/x-ndjson', headers=load_headers(200, scheduler))
+
     @app.route('/transcribe', methods=['POST'])
     def send_data():
-        content = request.json
-        response = { 
-            'transcript': asr( 
-                content['audio'],
-                content['language'],
-                content['history'],
-                int(content['beam_size']),
-                content['task'])
-            }
-        return jsonify(response)
+        try:
+            audio, content = parse_request()
+        except (KeyError, ValueError, RuntimeError) as e:
+            logging.error('bad request: {}'.format(e))
+            return jsonify({'error': str(e)}), 400
+        return transcribe(audio, content)
+
+    @app.route('/session', methods=['POST'])
+    def open_session():
+        """ opens a streaming session, the json body contains the default decoding options of the session """
+        try:
+            session = sessions.open(request.get_json(silent=True) or {})
+        except RuntimeError as e:
+            logging.error('cannot open session: {}'.format(e))
+            return jsonify({'error': str(e)}), 503
+        return jsonify({'session': session.sid, 'ttl': args.session_ttl, 'max_sec': args.session_max_sec})
+
+    @app.route('/session/<sid>/transcribe', methods=['POST'])
+    def session_transcribe(sid):
+        """
+        The request body contains the new samples of the stream (json or binary as in /transcribe), options contain:
+        offset: absolute position of the first sample sent
+        start, end: window [start, end) to transcribe (absolute positions), speech_chunks are relative to start
+        commit: (optional) samples before this position are released
+        The response contains the window actually transcribed (clipped to the samples kept by the session)
+        """
+        try:
+            session = sessions.get(sid)
+        except KeyError:
+            return jsonify({'error': 'unknown session {}'.format(sid)}), 404
+        try:
+            audio, content = parse_request()
+            session.append(np.asarray(audio, dtype=np.float32), int(content['offset']))
+            if content.get('commit') is not None:
+                session.trim(int(content['commit']))
+            start, end, audio = session.window(int(content['start']), int(content['end']))
+        except (KeyError, ValueError, RuntimeError) as e:
+            logging.error('bad request: {}'.format(e))
+            return jsonify({'error': str(e)}), 400
+        content = dict(session.options, **content)
+        if content.get('speech_chunks') is not None:
+            content['speech_chunks'] = session.clip_chunks(content['speech_chunks'], int(content['start']), start, end)
+        content.update(stream=sid, window=[start, end])
+        return transcribe(audio, content, window=[start, end])
+
+    @app.route('/session/<sid>/commit', methods=['POST'])
+    def session_commit(sid):
+        """ releases the samples of session sid before the absolute position given in the json body {'offset': n} """
+        try:
+            session = sessions.get(sid)
+        except KeyError:
+            return jsonify({'error': 'unknown session {}'.format(sid)}), 404
+        try:
+            session.trim(int(request.json['offset']))
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': 'bad request: {}'.format(e)}), 400
+        return jsonify({'start': session.start, 'end': session.end})
+
+    @app.route('/session/<sid>', methods=['DELETE'])
+    def close_session(sid):
+        if not sessions.close(sid):
+            return jsonify({'error': 'unknown session {}'.format(sid)}), 404
+        return jsonify({'closed': sid})
     
+    @app.route('/health', methods=['GET'])
+    def health():
+        """ health check used by clients balancing requests over several servers """
+        return jsonify({'status': 'ok', 'queued': len(asr), 'queue_wait': asr.estimated_wait()})
+
+    @app.route('/ready', methods=['GET'])
+    def readiness():
+        """ 200 once the models of --model_size and --final_model_size (and --models with --preload) are loaded, 503 before; lists the models loaded """
+        return jsonify({
+            'ready': ready.is_set(), 
+            'models': registry.loaded(), 
+            'memory_mb': round(registry.memory_mb(), 1), 
+            'memory_budget_mb': args.memory_budget_mb}), 200 if ready.is_set() else 503
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """ metrics in the Prometheus text exposition format """
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/stats', methods=['GET'])
+    def stats():
+        """ counts of requests served, coalesced (superseded by a newer request of the same stream), shed and failed """
+        stats = dict(asr.counts, queued=len(asr), sessions=len(sessions), queue_wait=asr.estimated_wait())
+        if final_asr is not asr:
+            stats['final'] = dict(final_asr.counts, queued=len(final_asr), queue_wait=final_asr.estimated_wait())
+        """ VAD time spent and saved (requests with the speech chunks of the client VAD) by all the replicas """
+        replicas = asr.replicas + (final_asr.replicas if final_asr is not asr else [])
+        vad = {k: sum(r.vad_stats[k] for r in replicas) for k in replicas[0].vad_stats}
+        vad['time_vad_saved_per_request'] = vad['time_vad_saved'] / max(1, vad['requests_client_vad'])
+        stats['vad'] = vad
+        stats['models'] = registry.loaded()
+        return jsonify(stats)
+
+    if args.ws_port:
+        WebSocketServer(asr, sessions, args.host, args.ws_port, args.sample_rate, partial_beam_size=args.partial_beam_size).start()
     app.run(host=args.host, port=args.port)
 
 
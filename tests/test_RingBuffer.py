@@ -0,0 +1,21 @@
+import unittest
+import numpy as np
+from python.RingBuffer import RingBuffer
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_oldest_after_overflow(self):
+        """ unreleased samples overwritten by the capture are no longer readable, oldest() is where reads can start """
+        buffer = RingBuffer(16000)
+        buffer.append(np.zeros(10000, dtype=np.float32))
+        buffer.release(2000)
+        self.assertEqual(buffer.oldest(), 2000)
+        buffer.append(np.arange(10000, dtype=np.float32))
+        self.assertEqual(buffer.oldest(), 4000)
+        with self.assertRaises(IndexError):
+            buffer[2000:4100]
+        self.assertEqual(len(buffer[buffer.oldest():len(buffer)]), 16000)
+        self.assertEqual(buffer[19999:20000][0], 9999)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import random
+import unittest
+from python.ServerPool import ServerPool
+
+class TestServerPool(unittest.TestCase):
+
+    def test_recovered_server_receives_traffic(self):
+        """ a server back from ejection gets requests again with a sequential client (one outstanding request) """
+        random.seed(0)
+        pool = ServerPool(['http://a', 'http://b'], health_ms=0)
+        a, b = pool.servers
+        pool.done(pool.pick(exclude=[a]), error='connection refused')
+        self.assertTrue(b.ejected)
+        pool.restore(b)
+        self.assertEqual(b.weight, pool.recovery_weight)
+        picks = []
+        for _ in range(100):
+            server = pool.pick()
+            picks.append(server)
+            pool.done(server, latency=0.1)
+        self.assertIn(b, picks)
+        self.assertEqual(b.weight, 1.0)
+        """ once fully recovered, the traffic is balanced again """
+        self.assertGreater(picks[-20:].count(b), 5)
+
+    def test_latency_stats(self):
+        pool = ServerPool(['http://a'], health_ms=0)
+        server = pool.pick()
+        pool.done(server, latency=0.2)
+        pool.done(pool.pick(), latency=0.4)
+        self.assertEqual(server.latencies, 2)
+        self.assertAlmostEqual(server.latency_sum / server.latencies, 0.3)
+
+if __name__ == '__main__':
+    unittest.main()